@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+"""Convert many presentations into GES projects with a pool of workers.
+
+Each worker process imports make-xges.py and initialises GStreamer
+once, then builds projects one after the other, so the start up cost
+and discovered assets shared between presentations (credits, backdrop,
+cursor) are reused.  A failing job is reported and does not stop the
+others.
+"""
+
+import argparse
+import concurrent.futures
+import importlib.util
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Set in each worker process by _init_worker()
+_make_xges = None
+
+
+def _needs_gstreamer(args):
+    """Whether a job's make-xges.py arguments need GStreamer."""
+    return '--dry-run' not in args
+
+
+def _init_worker(gstreamer):
+    global _make_xges
+    spec = importlib.util.spec_from_file_location(
+        'make_xges', os.path.join(HERE, 'make-xges.py'))
+    _make_xges = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(_make_xges)
+    if gstreamer:
+        _make_xges.init_gstreamer()
+
+
+def _run_job(args):
+    """Build one project in a worker, returning its result record."""
+    start = time.monotonic()
+    result = {'args': args}
+    try:
+        p = _make_xges.build(_make_xges.parse_args(args))
+    except SystemExit as e:
+        # Raised by argparse for invalid options
+        result['error'] = 'invalid arguments (exit status {})'.format(e.code)
+    except Exception:
+        result['error'] = traceback.format_exc()
+    else:
+        result['profile'] = p.profiler.report()
+    result['elapsed'] = time.monotonic() - start
+    return result
+
+
+def read_manifest(path):
+    """Read a JSON list of jobs.
+
+    Each job is an object with "basedir", "project" and an optional
+    list of "options" for make-xges.py.  Relative paths are relative
+    to the manifest.
+    """
+    with open(path, 'r') as fp:
+        entries = json.load(fp)
+    root = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    for entry in entries:
+        jobs.append((os.path.join(root, entry['basedir']),
+                     os.path.join(root, entry['project']),
+                     list(entry.get('options', []))))
+    return jobs
+
+
+def scan_directory(path, outdir=None, ext='.xges'):
+    """Make a job for each presentation in a directory of presentations.
+
+    Subdirectories without a shapes.svg are ignored.  Projects are
+    named after the presentation directory with the extension ext, and
+    are written to outdir (default: next to the presentation directory).
+    """
+    jobs = []
+    for name in sorted(os.listdir(path)):
+        basedir = os.path.join(path, name)
+        if not os.path.isfile(os.path.join(basedir, 'shapes.svg')):
+            continue
+        project = os.path.join(outdir or path, name + ext)
+        jobs.append((basedir, project, []))
+    return jobs
+
+
+def _run_pool(todo, results, queue, workers, context, gstreamer):
+    """Run the jobs popped from queue in a pool, storing their results.
+
+    At most one job per worker is queued at a time.  If a worker
+    process dies, the pool is abandoned and the indices of the jobs
+    that were running are returned (the rest stay in queue).
+    """
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=context,
+            initializer=_init_worker, initargs=(gstreamer,)) as executor:
+        running = {}
+        while queue or running:
+            while queue and len(running) < workers:
+                i = queue.pop()
+                running[executor.submit(_run_job, todo[i])] = i
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                try:
+                    result = future.result()
+                except concurrent.futures.process.BrokenProcessPool:
+                    broken = True
+                    continue
+                i = running.pop(future)
+                results[i] = result
+                print('{} {}: {:.1f}s'.format(
+                    'FAILED' if 'error' in result else 'done',
+                    todo[i][-1], result['elapsed']), flush=True)
+            if broken:
+                return list(running.values())
+    return []
+
+
+def run_batch(jobs, common_options, workers):
+    """Run the jobs in a pool of workers, returning their results in order.
+
+    When a worker process dies, the whole pool breaks, and it isn't
+    known which of the running jobs caused it.  Those jobs are run
+    again one at a time, and only a job that kills its worker when
+    running alone is reported as failed.  The others continue in a new
+    pool.
+    """
+    todo = [common_options + options + [basedir, project]
+            for basedir, project, options in jobs]
+    results = [None] * len(todo)
+    gstreamer = any(_needs_gstreamer(args) for args in todo)
+    pending = list(reversed(range(len(todo))))
+    suspects = []
+    context = multiprocessing.get_context('spawn')
+    while pending or suspects:
+        if suspects:
+            queue, size = [suspects.pop()], 1
+        else:
+            queue, size = pending, workers
+        crashed = _run_pool(todo, results, queue, size, context, gstreamer)
+        if len(crashed) == 1 and size == 1:
+            i = crashed[0]
+            results[i] = {'args': todo[i], 'elapsed': 0,
+                          'error': 'worker process died'}
+            print('FAILED {}: worker process died'.format(todo[i][-1]),
+                  flush=True)
+        else:
+            suspects.extend(crashed)
+    return results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='convert many BigBlueButton presentations into GES projects',
+        epilog='Options after "--" are passed to make-xges.py for every job.')
+    parser.add_argument('--jobs', '-j', metavar='N', type=int,
+                        default=os.cpu_count() or 4,
+                        help='Number of worker processes')
+    parser.add_argument('--outdir', metavar='DIR', type=str, default=None,
+                        help='Directory for the projects of a directory of '
+                        'presentations (default: the directory itself)')
+    parser.add_argument('--summary', metavar='FILE', type=str, default=None,
+                        help='Write the result and timings of every job to FILE as JSON')
+    parser.add_argument('source', metavar='MANIFEST-OR-DIR', type=str,
+                        help='JSON manifest of jobs, or a directory of presentation directories')
+    parser.add_argument('options', metavar='OPTION', nargs='*',
+                        help='make-xges.py options for every job')
+    opts = parser.parse_args(argv[1:])
+    if opts.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if os.path.isdir(opts.source):
+        # --dry-run writes JSON plans rather than projects
+        ext = '.xges' if _needs_gstreamer(opts.options) else '.json'
+        jobs = scan_directory(opts.source, opts.outdir, ext)
+    else:
+        jobs = read_manifest(opts.source)
+    if not jobs:
+        parser.error('no presentations found in {}'.format(opts.source))
+    if (any(_needs_gstreamer(opts.options + options) for _, _, options in jobs)
+            and importlib.util.find_spec('gi') is None):
+        parser.error('the GStreamer Python bindings (gi) are not installed')
+
+    start = time.monotonic()
+    results = run_batch(jobs, opts.options, min(opts.jobs, len(jobs)))
+    elapsed = time.monotonic() - start
+
+    failed = [r for r in results if 'error' in r]
+    job_time = sum(r['elapsed'] for r in results)
+    print('{} projects, {} failed, in {:.1f}s ({:.1f}s of work, {:.1f}s per project)'.format(
+        len(results), len(failed), elapsed, job_time, job_time / len(results)))
+    for r in failed:
+        print('\n{}:\n{}'.format(r['args'][-1], r['error'].rstrip()))
+    if opts.summary is not None:
+        with open(opts.summary, 'w') as fp:
+            json.dump({'elapsed': elapsed, 'jobs': results}, fp, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
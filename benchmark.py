@@ -0,0 +1,342 @@
+#!/usr/bin/python3
+"""Benchmarks for the time-critical parts of bbb-render.
+
+Each benchmark is run over synthetic inputs of increasing size, and
+reports the best time of several runs for each implementation.  The
+results can be saved as JSON and compared against a previous run to
+catch performance regressions.
+"""
+
+import argparse
+import contextlib
+import glob
+import importlib.util
+import io
+import json
+import operator
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from download import Downloader
+from mediainfo import MediaInfo, image_dimensions
+from planner import Planner
+from profiler import Profiler
+from sweep import locate, segment
+import synthetic
+
+try:
+    from intervaltree import IntervalTree
+except ImportError:
+    IntervalTree = None
+
+
+SECOND = 1000000000
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Delay added to each request to the stand-in HTTP server, so that
+# concurrent downloads have something to overlap
+DOWNLOAD_LATENCY = 0.01
+
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def synthetic_slides(count, rng):
+    """Return (start, end, id) intervals for consecutive slides."""
+    slides = []
+    t = 0
+    for i in range(count):
+        duration = rng.randint(10, 600) * SECOND
+        slides.append((t, t + duration, f'image{i}'))
+        t += duration
+    return slides
+
+
+def synthetic_shapes(count, slides, rng):
+    """Return (start, end, (index, id)) intervals of annotation shapes.
+
+    As in a real recording, shapes stay visible until undone or until
+    the end of their slide.
+    """
+    shapes = []
+    for index in range(count):
+        begin, end, _ = rng.choice(slides)
+        timestamp = rng.randint(begin, end)
+        if rng.random() < 0.7:
+            undo = end
+        else:
+            undo = rng.randint(timestamp, end)
+        shapes.append((timestamp, undo, (index, f'shape{index}')))
+    return shapes
+
+
+def intervaltree_locate(times, intervals):
+    tree = IntervalTree.from_tuples(intervals)
+    return [[i.data for i in tree.at(t)][0] for t in times]
+
+
+def intervaltree_segment(intervals):
+    t = IntervalTree()
+    for begin, end, data in intervals:
+        if begin < end:
+            t.addi(begin, end, [data])
+    t.split_overlaps()
+    t.merge_overlaps(strict=True, data_reducer=operator.add)
+    return [(i.begin, i.end, sorted(i.data)) for i in sorted(t)]
+
+
+_make_xges = None
+_have_gstreamer = None
+
+
+def load_make_xges(gstreamer=True):
+    """Import make-xges.py, initialising GStreamer unless gstreamer is False.
+
+    Returns None if GStreamer is needed but unavailable.
+    """
+    global _make_xges, _have_gstreamer
+    if _make_xges is None:
+        spec = importlib.util.spec_from_file_location(
+            'make_xges', os.path.join(HERE, 'make-xges.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _make_xges = module
+    if gstreamer and _have_gstreamer is None:
+        try:
+            _make_xges.init_gstreamer()
+            _have_gstreamer = True
+        except (ImportError, ValueError):
+            _have_gstreamer = False
+    if gstreamer and not _have_gstreamer:
+        return None
+    return _make_xges
+
+
+@contextlib.contextmanager
+def chdir(path):
+    old = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(old)
+
+
+def bench_cursor_lookup(size, rng, workdir):
+    """Assign each cursor event to the slide shown at that time."""
+    slides = synthetic_slides(max(1, size // 100), rng)
+    end = slides[-1][1]
+    times = sorted(rng.randrange(end) for _ in range(size))
+    impls = {'sweep': lambda: locate(times, slides)}
+    if IntervalTree is not None:
+        impls['intervaltree'] = lambda: intervaltree_locate(times, slides)
+    return impls
+
+
+def bench_annotation_segments(size, rng, workdir):
+    """Split annotation shapes into intervals with a constant shape set."""
+    slides = synthetic_slides(max(1, size // 50), rng)
+    shapes = synthetic_shapes(size, slides, rng)
+    impls = {'sweep': lambda: segment(shapes)}
+    if IntervalTree is not None:
+        impls['intervaltree'] = lambda: intervaltree_segment(shapes)
+    return impls
+
+
+def bench_presentation(size, rng, workdir):
+    """Build and save a project for a synthetic recording."""
+    make_xges = load_make_xges()
+    if make_xges is None:
+        return {}
+    basedir = os.path.join(workdir, f'presentation-{size}')
+    if not os.path.exists(basedir):
+        synthetic.generate(basedir, slides=max(2, size // 100), shapes=size,
+                           cursor_events=size, seed=rng.random())
+    project = os.path.join(workdir, f'presentation-{size}.xges')
+    args = ['--no-media-cache', basedir, project]
+
+    def build(extra=()):
+        # make-xges.py finds dot.png in the current directory
+        with chdir(basedir):
+            return make_xges.Presentation(make_xges.parse_args([*extra, *args]))
+
+    def build_only():
+        build()
+
+    def annotations():
+        for path in glob.glob(os.path.join(basedir, 'annotations-*.svg')):
+            os.unlink(path)
+        build(['--annotations'])
+
+    built = build()
+    return {
+        'build': build_only,
+        'annotations': annotations,
+        'save': built.save,
+    }
+
+
+def bench_planner(size, rng, workdir):
+    """Plan the clips for a synthetic recording, without GStreamer."""
+    make_xges = load_make_xges(gstreamer=False)
+    duration = 600
+    basedir = os.path.join(workdir, f'planner-{size}')
+    if not os.path.exists(basedir):
+        synthetic.generate(basedir, slides=max(2, size // 100), shapes=size,
+                           cursor_events=size, duration=duration, video=False,
+                           placeholder_size=1024, seed=rng.random())
+
+    # The videos are only placeholders, so describe them here
+    video = MediaInfo(width=640, height=480, duration=duration * SECOND,
+                      framerate_num=25, framerate_denom=1, audio_rate=48000,
+                      audio_channels=1, is_image=False)
+
+    def media(path):
+        if path.endswith('.webm'):
+            return video
+        width, height = image_dimensions(path)
+        return video._replace(width=width, height=height, duration=None,
+                              framerate_num=None, framerate_denom=None,
+                              audio_rate=None, audio_channels=None,
+                              is_image=True)
+
+    def plan(*extra):
+        opts = make_xges.parse_args(
+            [*extra, '--annotations', '--no-media-cache', basedir, '-'])
+        p = Planner(opts, media, Profiler(), dry_run=True)
+        # make-xges.py finds dot.png in the current directory
+        with chdir(basedir), contextlib.redirect_stdout(io.StringIO()):
+            p.set_window(opts)
+            p.load()
+            p.plan().to_json()
+
+    return {
+        'clips': plan,
+        'keyframes': lambda: plan('--cursor-mode=keyframes'),
+        'compact': lambda: plan('--compact'),
+    }
+
+
+def bench_download(size, rng, workdir):
+    """Download a synthetic recording from a local HTTP server."""
+    basedir = os.path.join(workdir, f'download-{size}')
+    if not os.path.exists(basedir):
+        synthetic.generate(basedir, slides=max(2, size // 10),
+                           shapes=size, cursor_events=size, video=False,
+                           placeholder_size=size * 1024, seed=rng.random())
+
+    def download(jobs, segments):
+        outdir = os.path.join(workdir, f'download-{size}-out')
+        shutil.rmtree(outdir, ignore_errors=True)
+        with synthetic.RecordingServer(basedir, latency=DOWNLOAD_LATENCY) as server:
+            d = Downloader(server.url, outdir, jobs=jobs, segments=segments)
+            with contextlib.redirect_stdout(io.StringIO()):
+                d.download()
+        return sorted(
+            (os.path.relpath(os.path.join(dirpath, name), outdir),
+             os.path.getsize(os.path.join(dirpath, name)))
+            for dirpath, _, names in os.walk(outdir)
+            for name in names if not name.startswith('.'))
+
+    return {
+        'sequential': lambda: download(1, 1),
+        'concurrent': lambda: download(8, 4),
+    }
+
+
+BENCHMARKS = {
+    'cursor-lookup': bench_cursor_lookup,
+    'annotation-segments': bench_annotation_segments,
+    'presentation': bench_presentation,
+    'planner': bench_planner,
+    'download': bench_download,
+}
+
+
+def compare(results, baseline, tolerance):
+    """Print the results that are slower than the baseline by more
+    than tolerance percent, and return how many there are."""
+    previous = {(r['benchmark'], r['size'], r['implementation']): r['seconds']
+                for r in baseline}
+    regressions = 0
+    for r in results:
+        old = previous.get((r['benchmark'], r['size'], r['implementation']))
+        if old is None:
+            continue
+        change = (r['seconds'] - old) / old * 100
+        if change > tolerance:
+            regressions += 1
+            print(f"{r['benchmark']} {r['size']} {r['implementation']}: "
+                  f"{old:.4f}s -> {r['seconds']:.4f}s ({change:+.0f}%)")
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='benchmark bbb-render')
+    parser.add_argument('--sizes', metavar='N,...', type=str,
+                        default='1000,10000',
+                        help='Comma separated input sizes')
+    parser.add_argument('--repeat', metavar='N', type=int, default=3,
+                        help='Number of runs per measurement')
+    parser.add_argument('--json', metavar='FILE', type=str, default=None,
+                        help='Also write the results as JSON')
+    parser.add_argument('--baseline', metavar='FILE', type=str, default=None,
+                        help='Compare against results previously written with --json')
+    parser.add_argument('--tolerance', metavar='PERCENT', type=float, default=20,
+                        help='Slowdown compared to the baseline that counts as '
+                        'a regression')
+    parser.add_argument('benchmarks', metavar='BENCHMARK', nargs='*',
+                        help='Benchmarks to run: {} (default: all)'.format(
+                            ', '.join(BENCHMARKS)))
+    opts = parser.parse_args(argv[1:])
+    for name in opts.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f'unknown benchmark: {name}')
+    sizes = [int(size) for size in opts.sizes.split(',')]
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix='bbb-benchmark-') as workdir:
+        for name in opts.benchmarks or BENCHMARKS:
+            for size in sizes:
+                impls = BENCHMARKS[name](size, random.Random(size), workdir)
+                if not impls:
+                    print(f'{name:24} {size:>9} skipped (requires GStreamer)')
+                    continue
+                outputs = {}
+                for impl, func in impls.items():
+                    elapsed, outputs[impl] = best_time(func, opts.repeat)
+                    results.append({'benchmark': name, 'size': size,
+                                    'implementation': impl, 'seconds': elapsed})
+                    print(f'{name:24} {size:>9} {impl:14} {elapsed:10.4f}s')
+                # Alternative implementations must agree with the first
+                reference_impl, reference = next(iter(outputs.items()))
+                for impl, output in outputs.items():
+                    if output is not None and output != reference:
+                        print(f'{name}: {impl} result differs from {reference_impl}')
+                        return 1
+
+    if opts.json is not None:
+        with open(opts.json, 'w') as fp:
+            json.dump(results, fp, indent=1)
+    if opts.baseline is not None:
+        with open(opts.baseline, 'r') as fp:
+            baseline = json.load(fp)
+        if compare(results, baseline, opts.tolerance):
+            return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,16 +1,423 @@
 #!/usr/bin/python3
 
+import argparse
+import base64
+import concurrent.futures
+import contextlib
+import fcntl
+import hashlib
+import http.client
+import json
 import os
 import re
+import shutil
 import sys
+import threading
+import time
+import urllib.error
 import urllib.parse
 import urllib.request
-import xml.etree.ElementTree as ET
+
+from recording import image_hrefs, parse_time
+
+
+USER_AGENT = 'bbb-video-downloader/1.0'
+REDIRECT_CODES = {301, 302, 303, 307, 308}
+MAX_REDIRECTS = 10
+
+# Files large enough to be worth fetching as parallel byte ranges
+LARGE_FILES = ('video/webcams.webm', 'deskshare/deskshare.webm')
+MIN_SEGMENT_SIZE = 1024 * 1024
+
+MANIFEST_NAME = '.download-manifest.json'
+
+# ioctl to share the data blocks of another file (Linux)
+FICLONE = 0x40049409
+
+
+def _parse_content_range(resp):
+    """Return (first, last, total) from a response's Content-Range header.
+
+    Unknown values are returned as None.
+    """
+    m = re.match(r'^bytes\s+(\d+)-(\d+)/(\d+|\*)$',
+                 resp.getheader('Content-Range', '').strip())
+    if m is None:
+        return None, None, None
+    total = None if m.group(3) == '*' else int(m.group(3))
+    return int(m.group(1)), int(m.group(2)), total
+
+
+def _validators(resp):
+    return {
+        'etag': resp.getheader('ETag'),
+        'last_modified': resp.getheader('Last-Modified'),
+    }
+
+
+def _conditional_headers(entry):
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+def _if_range(entry):
+    """Return a validator suitable for an If-Range header, or None."""
+    etag = entry.get('etag')
+    # Weak ETags can't be used with If-Range
+    if etag and not etag.startswith('W/'):
+        return etag
+    return entry.get('last_modified')
+
+
+def _tmp_name(path):
+    return f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+
+def _write_json(path, data):
+    # Write atomically so a crash never leaves a truncated file
+    tmp = _tmp_name(path)
+    with open(tmp, 'w') as fp:
+        json.dump(data, fp, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _link_or_copy(src, dst):
+    """Atomically make dst a hard link, reflink or copy of src."""
+    tmp = _tmp_name(dst)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        try:
+            with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+                try:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                except OSError:
+                    shutil.copyfileobj(fsrc, fdst)
+        except BaseException:
+            _unlink(tmp)
+            raise
+    os.replace(tmp, dst)
+
+
+def _sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class AssetCache:
+    """Content addressed store of downloaded files shared between presentations.
+
+    File contents are stored under objects/ named by their SHA-256
+    hash, and urls/ maps each URL to the hash and HTTP validators of
+    its last download.  Cached files are hard linked (or reflinked, or
+    as a last resort copied) into each presentation's output
+    directory.
+
+    Every update is an atomic rename made while holding a shared lock,
+    and eviction of the least recently used objects holds the lock
+    exclusively, so several downloaders can use one cache at a time.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(os.path.join(path, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(path, 'urls'), exist_ok=True)
+
+    @contextlib.contextmanager
+    def _lock(self, exclusive=False):
+        with open(os.path.join(self.path, 'lock'), 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def _url_path(self, url):
+        digest = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, 'urls', digest + '.json')
+
+    def _object_path(self, digest):
+        return os.path.join(self.path, 'objects', digest[:2], digest)
+
+    def _touch(self, obj):
+        # Record use in the access time, leaving the modification time
+        # (shared with linked copies) alone.
+        os.utime(obj, (time.time(), os.stat(obj).st_mtime))
+
+    def lookup(self, url):
+        """Return the cache entry for url, or None."""
+        try:
+            with open(self._url_path(url), 'r') as fp:
+                entry = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if entry.get('url') != url:
+            return None
+        if not os.path.exists(self._object_path(entry['sha256'])):
+            return None
+        return entry
+
+    def link(self, entry, outpath):
+        """Place the cached file for entry at outpath.
+
+        Returns False if the file has since been evicted.
+        """
+        obj = self._object_path(entry['sha256'])
+        with self._lock():
+            try:
+                _link_or_copy(obj, outpath)
+                self._touch(obj)
+            except FileNotFoundError:
+                return False
+        return True
+
+    def store(self, url, path, validators):
+        """Add a freshly downloaded file to the cache."""
+        digest = _sha256_file(path)
+        obj = self._object_path(digest)
+        with self._lock():
+            if os.path.exists(obj):
+                # Another URL had the same content: share that copy
+                _link_or_copy(obj, path)
+            else:
+                os.makedirs(os.path.dirname(obj), exist_ok=True)
+                _link_or_copy(path, obj)
+            self._touch(obj)
+            _write_json(self._url_path(url), dict(
+                url=url, sha256=digest, size=os.path.getsize(obj),
+                **validators))
+
+    def evict(self):
+        """Remove least recently used objects until under max_size."""
+        with self._lock(exclusive=True):
+            objects = []
+            for dirpath, dirnames, filenames in os.walk(
+                    os.path.join(self.path, 'objects')):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    st = os.stat(path)
+                    objects.append((st.st_atime, st.st_size, path))
+            total = sum(size for _, size, _ in objects)
+            for _, size, path in sorted(objects):
+                if total <= self.max_size:
+                    break
+                os.unlink(path)
+                total -= size
+            # URL entries pointing at evicted objects are ignored by
+            # lookup(), so drop them too.
+            urls = os.path.join(self.path, 'urls')
+            for name in os.listdir(urls):
+                path = os.path.join(urls, name)
+                try:
+                    with open(path, 'r') as fp:
+                        digest = json.load(fp)['sha256']
+                except (OSError, ValueError, KeyError):
+                    continue
+                if not os.path.exists(self._object_path(digest)):
+                    _unlink(path)
+
+
+class Manifest:
+    """Record of downloaded files, stored in the output directory.
+
+    Each entry holds the size and ETag/Last-Modified validators of a
+    file, whether it was completely downloaded and, for files fetched
+    as parallel byte ranges, which ranges are still outstanding.
+
+    Changes are written out at most every SAVE_INTERVAL seconds, when
+    a byte range finishes and by save().  After a crash, files whose
+    entries were lost are downloaded again in full, and a file still
+    recorded as incomplete although nothing is missing is revalidated
+    against the server.
+    """
+
+    SAVE_INTERVAL = 2.0
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._saved = time.monotonic()
+        try:
+            with open(path, 'r') as fp:
+                self.files = json.load(fp)['files']
+        except FileNotFoundError:
+            self.files = {}
+        except (ValueError, KeyError):
+            print(f"Ignoring corrupt manifest {path}")
+            self.files = {}
+
+    def get(self, path):
+        with self._lock:
+            entry = self.files.get(path)
+            return None if entry is None else dict(entry)
+
+    def set(self, path, **fields):
+        with self._lock:
+            self.files[path] = fields
+            self._dirty = True
+            if time.monotonic() - self._saved >= self.SAVE_INTERVAL:
+                self._save()
+
+    def finish_range(self, path, rng):
+        with self._lock:
+            self.files[path]['ranges'].remove(rng)
+            self._dirty = True
+            self._save()
+
+    def save(self):
+        """Write out any changes not saved yet."""
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    def _save(self):
+        _write_json(self.path, {'version': 1, 'files': self.files})
+        self._dirty = False
+        self._saved = time.monotonic()
+
+
+class ConnectionPool:
+    """Persistent HTTP connections, one per host for each thread.
+
+    Connections are kept alive between requests so that fetching many
+    small files from the same server doesn't pay for a new TCP (and
+    TLS) handshake every time.  Proxies are taken from the environment
+    (http_proxy, https_proxy and no_proxy), as with urllib.
+    """
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self.proxies = urllib.request.getproxies()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._all = []
+
+    def _proxy(self, scheme, netloc):
+        """Return the split URL of the proxy for scheme://netloc, or None."""
+        proxy = self.proxies.get(scheme)
+        if not proxy or urllib.request.proxy_bypass(netloc):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        parts = urllib.parse.urlsplit(proxy)
+        if parts.scheme != 'http':
+            raise ValueError(f"Unsupported proxy: {proxy}")
+        return parts
+
+    def _proxy_headers(self, proxy):
+        if proxy.username is None:
+            return {}
+        credentials = '{}:{}'.format(urllib.parse.unquote(proxy.username),
+                                     urllib.parse.unquote(proxy.password or ''))
+        return {'Proxy-Authorization': 'Basic ' + base64.b64encode(
+            credentials.encode('utf-8')).decode('ascii')}
+
+    def _connection(self, scheme, netloc):
+        conns = getattr(self._local, 'conns', None)
+        if conns is None:
+            conns = self._local.conns = {}
+        conn = conns.get((scheme, netloc))
+        if conn is None:
+            proxy = self._proxy(scheme, netloc)
+            if scheme == 'https':
+                if proxy is None:
+                    conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+                else:
+                    conn = http.client.HTTPSConnection(
+                        proxy.hostname, proxy.port or 80, timeout=self.timeout)
+                    conn.set_tunnel(netloc, headers=self._proxy_headers(proxy))
+            elif scheme == 'http':
+                if proxy is None:
+                    conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+                else:
+                    conn = http.client.HTTPConnection(
+                        proxy.hostname, proxy.port or 80, timeout=self.timeout)
+            else:
+                raise ValueError(f"Unsupported URL scheme: {scheme}")
+            conns[scheme, netloc] = conn
+            with self._lock:
+                self._all.append(conn)
+        return conn
+
+    def _discard(self, scheme, netloc):
+        conn = self._local.conns.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def discard(self, url):
+        """Drop this thread's connection to the host serving url."""
+        parts = urllib.parse.urlsplit(url)
+        self._discard(parts.scheme, parts.netloc)
+
+    def request(self, url, headers=None, method='GET'):
+        """Perform a request, following redirects.
+
+        Returns the http.client.HTTPResponse, which must be read to
+        completion before the thread issues another request to the
+        same host.  HTTP errors are raised as urllib.error.HTTPError.
+        """
+        headers = dict(headers or {})
+        headers.setdefault('User-Agent', USER_AGENT)
+        for _ in range(MAX_REDIRECTS):
+            parts = urllib.parse.urlsplit(url)
+            target = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+            request_headers = headers
+            proxy = self._proxy(parts.scheme, parts.netloc)
+            if parts.scheme == 'http' and proxy is not None:
+                # Plain HTTP proxies are sent the full URL
+                target = urllib.parse.urlunsplit(parts._replace(fragment=''))
+                request_headers = dict(headers, **self._proxy_headers(proxy))
+            # A kept-alive connection may have been closed by the
+            # server since we last used it, so retry once on a fresh
+            # connection.
+            for attempt in range(2):
+                conn = self._connection(parts.scheme, parts.netloc)
+                try:
+                    conn.request(method, target, headers=request_headers)
+                    resp = conn.getresponse()
+                    break
+                except (http.client.RemoteDisconnected, ConnectionError):
+                    self._discard(parts.scheme, parts.netloc)
+                    if attempt:
+                        raise
+            if resp.status in REDIRECT_CODES and resp.getheader('Location'):
+                resp.read()
+                url = urllib.parse.urljoin(url, resp.getheader('Location'))
+                continue
+            if resp.status >= 400:
+                raise urllib.error.HTTPError(url, resp.status, resp.reason,
+                                             resp.headers, resp)
+            resp.url = url
+            return resp
+        raise urllib.error.URLError(f"Too many redirects: {url}")
+
+    def close(self):
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all.clear()
 
 
 class Downloader:
 
-    def __init__(self, url, outdir):
+    def __init__(self, url, outdir, jobs=1, segments=1, force=False,
+                 start=0, end=None, cache=None):
         m = re.match(r'^.*/playback/presentation/2\.0/playback\.html\?meetingId=(\S+)$', url)
         if m is not None:
             id = m.group(1)
@@ -24,60 +431,370 @@ class Downloader:
         id = m.group(1)
         self.base_url = urllib.parse.urljoin(url, f"/presentation/{id}/")
         self.outdir = outdir
+        self.jobs = jobs
+        self.segments = segments
+        self.force = force
+        self.start = start
+        self.end = end
+        self.cache = cache
+        self.pool = ConnectionPool()
+        os.makedirs(self.outdir, exist_ok=True)
+        self.manifest = Manifest(os.path.join(self.outdir, MANIFEST_NAME))
+        self._stats_lock = threading.Lock()
+        self.bytes_downloaded = 0
+        self.files_downloaded = 0
+        self.files_skipped = 0
+        self.files_cached = 0
 
-    def _get(self, path):
+    def _count(self, nbytes, nfiles=0, nskipped=0, ncached=0):
+        with self._stats_lock:
+            self.bytes_downloaded += nbytes
+            self.files_downloaded += nfiles
+            self.files_skipped += nskipped
+            self.files_cached += ncached
+
+    def _paths(self, path):
         url = urllib.parse.urljoin(self.base_url, path)
         outpath = os.path.join(self.outdir, path)
         os.makedirs(os.path.dirname(outpath), exist_ok=True)
+        return url, outpath
 
-        print(f"Downloading {url}...")
-        with open(outpath, 'wb') as fp:
-            buf = bytearray(64 * 1024)
-            req = urllib.request.Request(url)
-            req.add_header('User-Agent', 'bbb-video-downloader/1.0')
-            resp = urllib.request.urlopen(req)
-            content_length = resp.headers['Content-Length']
-            if content_length is not None: content_length = int(content_length)
-            while True:
-                with resp:
+    def _entry(self, path, outpath):
+        """Return the manifest entry for path if it matches the file on disk."""
+        if self.force:
+            return None
+        entry = self.manifest.get(path)
+        try:
+            size = os.path.getsize(outpath)
+        except OSError:
+            return None
+        if entry is not None:
+            entry['current_size'] = size
+        return entry
+
+    def _up_to_date(self, path, resp, entry=None):
+        """Keep the file after the server returned 304.
+
+        If entry is given and not marked complete, it is now.
+        """
+        resp.read()
+        if entry is not None and not entry.get('complete'):
+            self.manifest.set(path, complete=True, size=entry['current_size'],
+                              etag=entry.get('etag'),
+                              last_modified=entry.get('last_modified'))
+        print(f"{path} is up to date")
+        self._count(0, nskipped=1)
+
+    def _lookup_cache(self, url, use_cache):
+        if self.cache is None or not use_cache:
+            return None
+        return self.cache.lookup(url)
+
+    def _link_cached(self, path, outpath, resp, cached):
+        """Link a cached file into place after the server returned 304.
+
+        Returns False if the cached copy has since been evicted.
+        """
+        resp.read()
+        if not self.cache.link(cached, outpath):
+            return False
+        print(f"{path} is up to date in the cache")
+        self.manifest.set(path, complete=True, size=cached['size'],
+                          etag=cached.get('etag'),
+                          last_modified=cached.get('last_modified'))
+        self._count(0, ncached=1)
+        return True
+
+    def _finished(self, path, url, outpath, size, validators):
+        self.manifest.set(path, complete=True, size=size, **validators)
+        if self.cache is not None:
+            self.cache.store(url, outpath, validators)
+        self._count(0, 1)
+
+    def _stream(self, url, fp, resp, if_range=None):
+        """Copy the body of resp to fp, resuming on short reads."""
+        buf = bytearray(64 * 1024)
+        content_length = resp.headers['Content-Length']
+        if content_length is not None:
+            content_length = fp.seek(0, os.SEEK_CUR) + int(content_length)
+        while True:
+            with resp:
+                try:
                     n = resp.readinto(buf)
                     while n > 0:
                         fp.write(buf[:n])
+                        self._count(n)
                         n = resp.readinto(buf)
-                current = fp.seek(0, os.SEEK_CUR)
-                if content_length is None or current >= content_length:
-                    break
-                print("continuing...")
-                req = urllib.request.Request(url)
-                req.add_header('User-Agent', 'bbb-video-downloader/1.0')
-                req.add_header('Range', f'bytes={current}-')
-                resp = urllib.request.urlopen(req)
+                except (http.client.HTTPException, OSError) as e:
+                    # Treat a dropped connection as a short read
+                    print(f"{url}: {e}")
+                    self.pool.discard(resp.url)
+            current = fp.seek(0, os.SEEK_CUR)
+            if content_length is None or current >= content_length:
+                break
+            print("continuing...")
+            headers = {'Range': f'bytes={current}-'}
+            if if_range is not None:
+                headers['If-Range'] = if_range
+            resp = self.pool.request(url, headers)
+            if resp.status != http.client.PARTIAL_CONTENT:
+                # The server ignored the range, so start over
+                fp.seek(0)
+                fp.truncate()
+
+    def _save_stream(self, path, url, outpath, resp, offset=0):
+        """Write the body of resp to outpath, starting at offset."""
+        validators = _validators(resp)
+        self.manifest.set(path, complete=False, **validators)
+        if offset:
+            if os.stat(outpath).st_nlink > 1:
+                # Also linked into the cache: resume a copy of it instead
+                tmp = _tmp_name(outpath)
+                shutil.copyfile(outpath, tmp)
+                os.replace(tmp, outpath)
+            fp = open(outpath, 'r+b')
+            fp.seek(offset)
+            fp.truncate()
+        else:
+            # The old file may be linked to the cache: don't overwrite it
+            _unlink(outpath)
+            fp = open(outpath, 'wb')
+        with fp:
+            self._stream(url, fp, resp, _if_range(validators))
+            size = fp.seek(0, os.SEEK_CUR)
+        self._finished(path, url, outpath, size, validators)
+
+    def _get(self, path, use_cache=True):
+        url, outpath = self._paths(path)
+        entry = self._entry(path, outpath)
+        headers = {}
+        offset = 0
+        if entry is not None:
+            if entry.get('complete') and entry['current_size'] == entry.get('size'):
+                # Revalidate a complete file
+                headers = _conditional_headers(entry)
+            elif (not entry.get('complete') and 'ranges' not in entry and
+                  entry['current_size'] > 0 and _if_range(entry)):
+                # Resume a truncated file, unless it has changed
+                offset = entry['current_size']
+                headers = {'Range': f'bytes={offset}-',
+                           'If-Range': _if_range(entry)}
+        cached = None
+        if not headers:
+            cached = self._lookup_cache(url, use_cache)
+            if cached is not None:
+                headers = _conditional_headers(cached)
+
+        print(f"Downloading {url}...")
+        try:
+            resp = self.pool.request(url, headers)
+        except urllib.error.HTTPError as e:
+            if not offset or e.code != http.client.REQUESTED_RANGE_NOT_SATISFIABLE:
+                raise
+            # Nothing is missing: the file was finished, but the last
+            # run stopped before recording that.  Revalidate it instead.
+            e.read()
+            offset = 0
+            resp = self.pool.request(url, _conditional_headers(entry))
+        if resp.status == http.client.NOT_MODIFIED:
+            if cached is None:
+                self._up_to_date(path, resp, entry)
+            elif not self._link_cached(path, outpath, resp, cached):
+                return self._get(path, use_cache=False)
+            return outpath
+        if resp.status == http.client.PARTIAL_CONTENT:
+            print(f"resuming {path} at {offset}...")
+        else:
+            offset = 0
+        self._save_stream(path, url, outpath, resp, offset)
+        return outpath
+
+    def _get_range(self, url, fd, start, end, if_range):
+        """Fetch bytes start..end (inclusive) of url into fd at the same offset."""
+        buf = bytearray(64 * 1024)
+        view = memoryview(buf)
+        pos = start
+        while pos <= end:
+            headers = {'Range': f'bytes={pos}-{end}'}
+            if if_range is not None:
+                headers['If-Range'] = if_range
+            resp = self.pool.request(url, headers)
+            with resp:
+                if (resp.status != http.client.PARTIAL_CONTENT or
+                        _parse_content_range(resp)[0] != pos):
+                    resp.read()
+                    raise urllib.error.URLError(
+                        f"{url}: server stopped honouring byte ranges")
+                try:
+                    n = resp.readinto(buf)
+                    while n > 0:
+                        os.pwrite(fd, view[:n], pos)
+                        pos += n
+                        self._count(n)
+                        n = resp.readinto(buf)
+                except (http.client.HTTPException, OSError) as e:
+                    print(f"{url}: {e}")
+                    self.pool.discard(resp.url)
+            if pos <= end:
+                print(f"continuing {url} at {pos}...")
+
+    def _get_segmented(self, path, use_cache=True):
+        """Download a large file over several connections at once.
+
+        The file is split into byte ranges which are fetched in
+        parallel and written in place into a preallocated output
+        file.  If the server doesn't support ranges or doesn't report
+        the file size, this falls back to a single stream.
+        """
+        if self.segments <= 1:
+            return self._get(path)
+        url, outpath = self._paths(path)
+        entry = self._entry(path, outpath)
+        headers = {'Range': 'bytes=0-0'}
+        pending = None
+        if entry is not None and entry['current_size'] == entry.get('size'):
+            # No ranges left means the file was finished, but the last
+            # run stopped before recording that.
+            if entry.get('complete') or entry.get('ranges') == []:
+                headers.update(_conditional_headers(entry))
+            elif entry.get('ranges') and _if_range(entry):
+                headers['If-Range'] = _if_range(entry)
+                pending = entry['ranges']
+        cached = None
+        if len(headers) == 1:
+            cached = self._lookup_cache(url, use_cache)
+            if cached is not None:
+                headers.update(_conditional_headers(cached))
+
+        print(f"Downloading {url}...")
+        try:
+            resp = self.pool.request(url, headers)
+        except urllib.error.HTTPError as e:
+            # An empty file can't satisfy any range
+            if e.code != http.client.REQUESTED_RANGE_NOT_SATISFIABLE:
+                raise
+            e.read()
+            return self._get(path)
+        if resp.status == http.client.NOT_MODIFIED:
+            if cached is None:
+                self._up_to_date(path, resp, entry)
+            elif not self._link_cached(path, outpath, resp, cached):
+                return self._get_segmented(path, use_cache=False)
+            return outpath
+        if resp.status != http.client.PARTIAL_CONTENT:
+            # Range was ignored (or the file changed since the partial
+            # download), so the full body is on its way
+            self._save_stream(path, url, outpath, resp)
+            return outpath
+        resp.read()
+        total = _parse_content_range(resp)[2]
+        if total is None:
+            return self._get(path)
+
+        validators = _validators(resp)
+        if pending is None:
+            nsegments = max(1, min(self.segments, total // MIN_SEGMENT_SIZE))
+            bounds = [total * i // nsegments for i in range(nsegments + 1)]
+            pending = [[bounds[i], bounds[i + 1] - 1] for i in range(nsegments)]
+            _unlink(outpath)
+            fd = os.open(outpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+            try:
+                if hasattr(os, 'posix_fallocate') and total > 0:
+                    os.posix_fallocate(fd, 0, total)
+                else:
+                    os.ftruncate(fd, total)
+            except BaseException:
+                os.close(fd)
+                raise
+        else:
+            print(f"resuming {len(pending)} ranges of {path}...")
+            fd = os.open(outpath, os.O_WRONLY)
+        self.manifest.set(path, complete=False, size=total,
+                          ranges=pending, **validators)
+        self.manifest.save()
+
+        def fetch(rng):
+            self._get_range(url, fd, rng[0], rng[1], _if_range(validators))
+            self.manifest.finish_range(path, rng)
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(pending)) as executor:
+                for _ in executor.map(fetch, list(pending)):
+                    pass
+        finally:
+            os.close(fd)
+        self._finished(path, url, outpath, total, validators)
         return outpath
 
     def download(self):
+        start = time.monotonic()
         self._get('metadata.xml')
         shapes = self._get('shapes.svg')
-        doc = ET.parse(shapes)
-        for imgurl in {img.get('{http://www.w3.org/1999/xlink}href')
-                       for img in doc.iterfind('.//{http://www.w3.org/2000/svg}image')}:
-            self._get(imgurl)
+        paths = sorted(image_hrefs(shapes, self.start, self.end))
 
-        self._get('panzooms.xml')
-        self._get('cursor.xml')
-        self._get('deskshare.xml')
-        self._get('presentation_text.json')
-        self._get('captions.json')
-        self._get('slides_new.xml')
+        paths.extend([
+            'panzooms.xml',
+            'cursor.xml',
+            'deskshare.xml',
+            'presentation_text.json',
+            'captions.json',
+            'slides_new.xml',
+        ])
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                # Start the large videos first so they overlap with
+                # the many small files.
+                futures = [executor.submit(self._get_segmented, path)
+                           for path in LARGE_FILES]
+                futures.extend(executor.submit(self._get, path)
+                               for path in paths)
+                for future in futures:
+                    future.result()
+        finally:
+            self.pool.close()
+            self.manifest.save()
+        if self.cache is not None:
+            self.cache.evict()
 
-        self._get('video/webcams.webm')
-        self._get('deskshare/deskshare.webm')
+        elapsed = time.monotonic() - start
+        mib = self.bytes_downloaded / (1024 * 1024)
+        print(f"Downloaded {self.files_downloaded} files, {mib:.1f} MiB "
+              f"in {elapsed:.1f}s ({mib / max(elapsed, 1e-6):.2f} MiB/s), "
+              f"{self.files_skipped} already up to date, "
+              f"{self.files_cached} from the cache")
 
 
 def main(argv):
-    if len(argv) != 3:
-        sys.stderr.write('usage: {} PRESENTATION-URL OUTPUT-DIR\n'.format(argv[0]))
-        return 1
-    d = Downloader(argv[1], argv[2])
+    parser = argparse.ArgumentParser(description='download the assets for a BigBlueButton presentation')
+    parser.add_argument('--jobs', '-j', metavar='N', type=int, default=4,
+                        help='Number of files to download concurrently')
+    parser.add_argument('--segments', metavar='N', type=int, default=4,
+                        help='Number of parallel byte ranges for the webcam and deskshare videos')
+    parser.add_argument('--force', action='store_true', default=False,
+                        help='Download every file again, ignoring the manifest')
+    parser.add_argument('--start', metavar='TIME', type=parse_time, default=0,
+                        help='Skip slides that end before this point in the recording')
+    parser.add_argument('--end', metavar='TIME', type=parse_time, default=None,
+                        help='Skip slides that start after this point in the recording')
+    parser.add_argument('--cache', metavar='DIR', type=str, default=None,
+                        help='Shared cache of downloaded assets')
+    parser.add_argument('--cache-size', metavar='MIB', type=int, default=10240,
+                        help='Maximum size of the shared cache in MiB')
+    parser.add_argument('url', metavar='PRESENTATION-URL', type=str,
+                        help='URL of the recorded presentation')
+    parser.add_argument('outdir', metavar='OUTPUT-DIR', type=str,
+                        help='directory to store the presentation assets')
+    opts = parser.parse_args(argv[1:])
+    if opts.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if opts.segments < 1:
+        parser.error('--segments must be at least 1')
+    cache = None
+    if opts.cache is not None:
+        cache = AssetCache(opts.cache, opts.cache_size * 1024 * 1024)
+    d = Downloader(opts.url, opts.outdir, jobs=opts.jobs,
+                   segments=opts.segments, force=opts.force,
+                   start=opts.start, end=opts.end, cache=cache)
     d.download()
 
 
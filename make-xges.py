@@ -2,25 +2,39 @@
 
 import argparse
 import collections
-import operator
+import concurrent.futures
+import contextlib
+import copy
+import functools
+import hashlib
+import json
 import os
+import shutil
+import subprocess
+import tempfile
+import time
 import sys
-import xml.etree.ElementTree as ET
 
-import gi
-gi.require_version('Gst', '1.0')
-gi.require_version('GstPbutils', '1.0')
-gi.require_version('GES', '1.0')
-from gi.repository import GLib, GObject, Gst, GstPbutils, GES
-from intervaltree import IntervalTree
+from mediainfo import MediaInfo, MediaInfoCache, image_dimensions
+from planner import SECOND, Planner, file_identity, parse_xml
+from profiler import Profiler
+from recording import parse_time
 
-# GStreamer's content detection doesn't work well with ElementTree's
-# automatically assigned namespace prefixes.
-ET.register_namespace("", "http://www.w3.org/2000/svg")
+# Imported by init_gstreamer(), so that --dry-run can run without them
+GLib = GObject = Gst = GstController = GstPbutils = GES = None
 
 
-SlideInfo = collections.namedtuple('SlideInfo', ['id', 'width', 'height', 'start', 'end'])
-CursorEvent = collections.namedtuple('CursorEvent', ['x', 'y', 'start'])
+def init_gstreamer():
+    """Import and initialise GStreamer and the editing services."""
+    global GLib, GObject, Gst, GstController, GstPbutils, GES
+    import gi
+    gi.require_version('Gst', '1.0')
+    gi.require_version('GstPbutils', '1.0')
+    gi.require_version('GstController', '1.0')
+    gi.require_version('GES', '1.0')
+    from gi.repository import GLib, GObject, Gst, GstController, GstPbutils, GES
+    Gst.init(None)
+    GES.init()
 
 
 def file_to_uri(path):
@@ -28,13 +42,91 @@ def file_to_uri(path):
     return 'file://' + path
 
 
+def asset_media_info(asset):
+    """Return the MediaInfo of a discovered GES.UriClipAsset."""
+    disco_info = asset.get_info()
+    video_streams = disco_info.get_video_streams()
+    audio_streams = disco_info.get_audio_streams()
+    info = MediaInfo(
+        width=None, height=None, framerate_num=None, framerate_denom=None,
+        audio_rate=None, audio_channels=None,
+        duration=asset.props.duration, is_image=asset.is_image())
+    if video_streams:
+        video_info = video_streams[0]
+        info = info._replace(
+            width=video_info.get_width(),
+            height=video_info.get_height(),
+            framerate_num=video_info.get_framerate_num(),
+            framerate_denom=video_info.get_framerate_denom())
+    if audio_streams:
+        audio_info = audio_streams[0]
+        info = info._replace(
+            audio_rate=audio_info.get_sample_rate(),
+            audio_channels=audio_info.get_channels())
+    return info
+
+
+# Height of the preview proxies made with --proxies
+PROXY_HEIGHT = 360
+
+
+def proxy_command(src, dst, width, height, audio):
+    """Return a gst-launch command transcoding src to an MJPEG proxy.
+
+    Every frame of the proxy is a keyframe, so seeking and scrubbing
+    while editing is cheap.
+    """
+    command = [
+        'gst-launch-1.0', '-q',
+        'filesrc', 'location={}'.format(src), '!', 'decodebin', 'name=dec',
+        'matroskamux', 'name=mux', '!', 'filesink', 'location={}'.format(dst),
+        'dec.', '!', 'video/x-raw', '!', 'queue', '!', 'videoconvert', '!',
+        'videoscale', '!', 'video/x-raw,width={},height={}'.format(width, height),
+        '!', 'jpegenc', 'quality=60', '!', 'queue', '!', 'mux.',
+    ]
+    if audio:
+        command += [
+            'dec.', '!', 'audio/x-raw', '!', 'queue', '!', 'audioconvert', '!',
+            'audio/x-raw,format=S16LE', '!', 'queue', '!', 'mux.',
+        ]
+    return command
+
+
+def transcode(command, dst):
+    tmp = '{}.{}.tmp.mkv'.format(dst, os.getpid())
+    try:
+        subprocess.run(command(tmp), check=True, stdout=subprocess.DEVNULL)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    os.replace(tmp, dst)
+
+
 class Presentation:
+    """A GES project for a presentation.
+
+    The clips are worked out by a Planner, and then added to the
+    timeline by emit().
+    """
 
-    def __init__(self, opts):
+    def __init__(self, opts, layout=True):
         self.opts = opts
-        self.cam_width = round(opts.width * opts.webcam_size / 100)
-        self.slides_width = opts.width - self.cam_width
+        self.profiler = Profiler()
 
+        self._assets = {}
+        # Maps source video paths to their preview proxies
+        self.proxies = {}
+        self.media_cache = MediaInfoCache(opts.media_cache)
+        self.planner = Planner(opts, self._media_info, self.profiler)
+        self._new_timeline()
+
+        # Construct the presentation.  If layout is False, the
+        # recording is only loaded, ready for set_window().
+        self._run_stages(preload=True, layout=layout)
+        self.media_cache.save()
+
+    def _new_timeline(self):
         self.timeline = GES.Timeline.new_audio_video()
 
         # Get the timeline's two tracks
@@ -42,104 +134,119 @@ class Presentation:
         if self.video_track.type == GES.TrackType.AUDIO:
             self.video_track, self.audio_track = self.audio_track, self.video_track
         self.project = self.timeline.get_asset()
-        self._assets = {}
-
-        # Construct the presentation
-        self.set_track_caps()
-        self.set_project_metadata()
-        self.add_credits()
-        self.add_webcams()
-        self.add_slides(self.opts.annotations)
-        self.add_deskshare()
-        self.add_backdrop()
+        for asset in self._assets.values():
+            self.project.add_asset(asset)
 
-    def _add_layer(self, name):
-        layer = self.timeline.append_layer()
-        layer.register_meta_string(GES.MetaFlag.READWRITE, 'video::name', name)
-        return layer
+    def _run_stages(self, preload=False, layout=True):
+        stages = [
+            ('set_track_caps', self.set_track_caps),
+            ('set_project_metadata', self.set_project_metadata),
+        ]
+        if preload:
+            stages.append(('preload_assets', self.preload_assets))
+        for name, stage in stages:
+            with self.profiler.stage(name):
+                stage()
+        if layout:
+            plan = self.planner.plan()
+            with self.profiler.stage('emit'):
+                self.emit(plan)
+
+    def set_window(self, opts):
+        """Lay out a new timeline for another part of the recording.
+
+        opts may only differ from the options the presentation was
+        created with in the start and end points, credits and output
+        files, and the part must lie within the original start and
+        end.  Nothing is parsed or discovered again, and annotation
+        files are reused.
+        """
+        self.opts = opts
+        self._new_timeline()
+        self._run_stages()
+        self.media_cache.save()
 
     def _get_asset(self, path):
         asset = self._assets.get(path)
         if asset is None:
+            start = time.perf_counter()
             asset = GES.UriClipAsset.request_sync(file_to_uri(path))
+            self.profiler.count('discovery_time', time.perf_counter() - start)
+            self.profiler.count('assets_requested')
             self.project.add_asset(asset)
             self._assets[path] = asset
         return asset
 
-    def _get_dimensions(self, asset):
-        info = asset.get_info()
-        video_info = info.get_video_streams()[0]
-        return (video_info.get_width(), video_info.get_height())
-
-    def _constrain(self, dimensions, bounds):
-        width, height = dimensions
-        max_width, max_height = bounds
-        new_height = round(height * max_width / width)
-        if new_height <= max_height:
-            return max_width, new_height
-        return round(width * max_height / height), max_height
-
-    def _add_clip(self, layer, asset, start, inpoint, duration,
-                  posx, posy, width, height, trim_end=True):
-        if trim_end:
-            # Skip clips entirely after the end point
-            if start > self.end_time:
-                return
-            # Truncate clips that go past the end point
-            duration = min(duration, self.end_time - start)
-
-        # Skip clips entirely before the start point
-        if start + duration < self.start_time:
+    def _request_assets(self, paths):
+        """Discover assets asynchronously, a bounded number at a time.
+
+        This runs a GLib main loop until all requests have completed,
+        then raises the first error encountered (if any).
+        """
+        queue = collections.deque(
+            path for path in dict.fromkeys(paths) if path not in self._assets)
+        if not queue:
             return
-        # Rewrite start, inpoint, and duration to account for time skip
-        start -= self.start_time
-        if start < 0:
-            duration += start
-            if not asset.is_image():
-                inpoint += -start
-            start = 0
-
-        # Offset start point by the length of the opening credits
-        start += self.opening_length
-
-        clip = layer.add_asset(asset, start, inpoint, duration,
-                               GES.TrackType.UNKNOWN)
-        for element in clip.find_track_elements(
-                self.video_track, GES.TrackType.VIDEO, GObject.TYPE_NONE):
-            element.set_child_property("posx", posx)
-            element.set_child_property("posy", posy)
-            element.set_child_property("width", width)
-            element.set_child_property("height", height)
-        return clip
+        loop = GLib.MainLoop()
+        errors = []
+        in_flight = 0
+
+        def start_requests():
+            nonlocal in_flight
+            while queue and not errors and in_flight < self.opts.discovery_jobs:
+                path = queue.popleft()
+                in_flight += 1
+                GES.Asset.request_async(GES.UriClip, file_to_uri(path), None,
+                                        on_asset_loaded, path)
+            if in_flight == 0:
+                loop.quit()
+            return False
+
+        def on_asset_loaded(source, result, path):
+            nonlocal in_flight
+            in_flight -= 1
+            try:
+                asset = GES.Asset.request_finish(result)
+            except GLib.Error as e:
+                errors.append(e)
+            else:
+                self.project.add_asset(asset)
+                self._assets[path] = asset
+            start_requests()
+
+        self.profiler.count('assets_requested', len(queue))
+        start = time.perf_counter()
+        GLib.idle_add(start_requests)
+        loop.run()
+        self.profiler.count('discovery_time', time.perf_counter() - start)
+        if errors:
+            raise errors[0]
+
+    def _media_info(self, path):
+        """Return the MediaInfo for path, discovering it if not cached."""
+        info = self.media_cache.get(path)
+        if info is None:
+            info = asset_media_info(self._get_asset(path))
+            self.media_cache.put(path, info)
+        return info
 
     def set_track_caps(self):
+        # Work out the start and end time from options
+        self.planner.set_window(self.opts)
+
         # Set frame rate and audio rate based on webcam capture
-        asset = self._get_asset(
+        info = self._media_info(
             os.path.join(self.opts.basedir, 'video/webcams.webm'))
-        info = asset.get_info()
 
-        video_info = info.get_video_streams()[0]
         self.video_track.props.restriction_caps = Gst.Caps.from_string(
             'video/x-raw(ANY), width=(int){}, height=(int){}, '
             'framerate=(fraction){}/{}'.format(
                 self.opts.width, self.opts.height,
-                video_info.get_framerate_num(),
-                video_info.get_framerate_denom()))
+                info.framerate_num, info.framerate_denom))
 
-        audio_info = info.get_audio_streams()[0]
         self.audio_track.props.restriction_caps = Gst.Caps.from_string(
             'audio/x-raw(ANY), rate=(int){}, channels=(int){}'.format(
-                audio_info.get_sample_rate(), audio_info.get_channels()))
-
-        # Set start and end time from options
-        self.start_time = round(self.opts.start * Gst.SECOND)
-        if self.opts.end is None:
-            self.end_time = asset.props.duration
-        else:
-            self.end_time = round(self.opts.end * Gst.SECOND)
-
-        # Offset for the opening credits
-        self.opening_length = 0
+                info.audio_rate, info.audio_channels))
 
         # Add an encoding profile for the benefit of Pitivi
         profile = GstPbutils.EncodingContainerProfile.new(
@@ -152,294 +259,316 @@ class Presentation:
             Gst.Caps.from_string('audio/mpeg,mpegversion=4,base-profile=lc'),
             None, self.audio_track.props.restriction_caps, 0))
         self.project.add_encoding_profile(profile)
+        self.encoding_profile = profile
+        self.framerate = (info.framerate_num, info.framerate_denom)
 
     def set_project_metadata(self):
-        doc = ET.parse(os.path.join(self.opts.basedir, 'metadata.xml'))
+        doc = parse_xml(os.path.join(self.opts.basedir, 'metadata.xml'),
+                        self.profiler)
         name = doc.find('./meta/name')
         if name is not None:
             self.project.register_meta_string(
                 GES.MetaFlag.READWRITE, 'name', name.text.strip())
 
-    def add_webcams(self):
-        layer = self._add_layer('Camera')
-        asset = self._get_asset(
-            os.path.join(self.opts.basedir, 'video/webcams.webm'))
-        dims = self._get_dimensions(asset)
-        if self.opts.stretch_webcam or self.opts.crop_webcam:
-            dims = (dims[0] * 16/12, dims[1])
-        width, height = self._constrain(
-            dims, (self.cam_width, self.opts.height))
-
-        clip = self._add_clip(layer, asset, 0, 0, asset.props.duration,
-                              self.opts.width - width, 0,
-                              width, height)
-
-        if self.opts.crop_webcam:
-            effect = GES.Effect.new('aspectratiocrop aspect-ratio=16/9')
-            clip.add(effect)
-
-    def add_slides(self, with_annotations):
-        layer = self._add_layer('Slides')
-        doc = ET.parse(os.path.join(self.opts.basedir, 'shapes.svg'))
-        slides = {}
-        slide_time = IntervalTree()
-        for img in doc.iterfind('./{http://www.w3.org/2000/svg}image[@class="slide"]'):
-            info = SlideInfo(
-                id=img.get('id'),
-                width=int(img.get('width')),
-                height=int(img.get('height')),
-                start=round(float(img.get('in')) * Gst.SECOND),
-                end=round(float(img.get('out')) * Gst.SECOND),
-            )
-            slides[info.id] = info
-            slide_time.addi(info.start, info.end, info)
-
-            # Don't bother creating an asset for out of range slides
-            if info.end < self.start_time or info.start > self.end_time:
-                continue
-
-            path = img.get('{http://www.w3.org/1999/xlink}href')
-            # If this is a "deskshare" slide, don't show anything
-            if path.endswith('/deskshare.png'):
-                continue
-
-            asset = self._get_asset(os.path.join(self.opts.basedir, path))
-            width, height = self._constrain(
-                self._get_dimensions(asset),
-                (self.slides_width, self.opts.height))
-            self._add_clip(layer, asset, info.start, 0, info.end - info.start,
-                           0, 0, width, height)
-
-        # If we're not processing annotations, then we're done.
-        if not with_annotations:
-            return
-
-        cursor_layer = self._add_layer('Cursor')
-        # Move above the slides layer
-        self.timeline.move_layer(cursor_layer, cursor_layer.get_priority() - 1)
-        dot = self._get_asset('dot.png')
-        dot_width, dot_height = self._get_dimensions(dot)
-        cursor_doc = ET.parse(os.path.join(self.opts.basedir, 'cursor.xml'))
-        events = []
-        for event in cursor_doc.iterfind('./event'):
-            x, y = event.find('./cursor').text.split()
-            start = round(float(event.attrib['timestamp']) * Gst.SECOND)
-            events.append(CursorEvent(float(x), float(y), start))
-
-        for i, pos in enumerate(events):
-            # negative positions are used to indicate that no cursor
-            # should be displayed.
-            if pos.x < 0 and pos.y < 0:
-                continue
-
-            # Show cursor until next event or if it is the last event,
-            # the end of recording.
-            if i + 1 < len(events):
-                end = events[i + 1].start
-            else:
-                end = self.end_time
-
-            # Find the width/height of the slide corresponding to this
-            # point in time
-            info = [i.data for i in slide_time.at(pos.start)][0]
-            width, height = self._constrain(
-                (info.width, info.height),
-                (self.slides_width, self.opts.height))
-
-            self._add_clip(cursor_layer, dot, pos.start, 0, end - pos.start,
-                           round(width*pos.x - dot_width/2),
-                           round(height*pos.y - dot_height/2), dot_width, dot_height)
-
-        layer = self._add_layer('Annotations')
-        # Move above the slides layer
-        self.timeline.move_layer(layer, layer.get_priority() - 1)
-        for canvas in doc.iterfind('./{http://www.w3.org/2000/svg}g[@class="canvas"]'):
-            info = slides[canvas.get('image')]
-            t = IntervalTree()
-            for index, shape in enumerate(canvas.iterfind('./{http://www.w3.org/2000/svg}g[@class="shape"]')):
-                shape.set('style', shape.get('style').replace(
-                    'visibility:hidden;', ''))
-                timestamp = round(float(shape.get('timestamp')) * Gst.SECOND)
-                undo = round(float(shape.get('undo')) * Gst.SECOND)
-                if undo < 0:
-                    undo = info.end
-
-                # Clip timestamps to slide visibility
-                start = min(max(timestamp, info.start), info.end)
-                end = min(max(undo, info.start), info.end)
-
-                # Don't bother creating annotations for out of range times
-                if end < self.start_time or start > self.end_time:
-                    continue
-
-                t.addi(start, end, [(index, shape)])
-
-            t.split_overlaps()
-            t.merge_overlaps(strict=True, data_reducer=operator.add)
-            for index, interval in enumerate(sorted(t)):
-                svg = ET.Element('{http://www.w3.org/2000/svg}svg')
-                svg.set('version', '1.1')
-                svg.set('width', '{}px'.format(info.width))
-                svg.set('height', '{}px'.format(info.height))
-                svg.set('viewBox', '0 0 {} {}'.format(info.width, info.height))
-
-                # We want to discard all but the last version of each
-                # shape ID, which requires two passes.
-                shapes = sorted(interval.data)
-                shape_index = {}
-                for index, shape in shapes:
-                    shape_index[shape.get('shape')] = index
-                for index, shape in shapes:
-                    if shape_index[shape.get('shape')] != index: continue
-                    svg.append(shape)
-
-                path = os.path.join(
-                    self.opts.basedir,
-                    'annotations-{}-{}.svg'.format(info.id, index))
-                with open(path, 'wb') as fp:
-                    fp.write(ET.tostring(svg, xml_declaration=True))
-
-                asset = self._get_asset(path)
-                width, height = self._constrain(
-                    (info.width, info.height),
-                    (self.slides_width, self.opts.height))
-                self._add_clip(layer, asset, interval.begin, 0, interval.end - interval.begin,
-                               0, 0, width, height)
-
-    def add_deskshare(self):
-        doc = ET.parse(os.path.join(self.opts.basedir, 'deskshare.xml'))
-        events = doc.findall('./event')
-        if len(events) == 0:
+    def preload_assets(self):
+        """Discover every asset used by the project up front.
+
+        Discovery runs in parallel, and clips are only placed once it
+        has finished for every asset.
+        """
+        paths = self.planner.load()
+        if self.opts.proxies:
+            self._make_proxies(self.planner.videos)
+            paths.extend(self.proxies.values())
+        self._request_assets(paths)
+
+    def _make_proxies(self, paths):
+        """Transcode videos to low resolution proxies for previewing.
+
+        The transcodes run in parallel, one per CPU.  Proxies are named
+        after the identity of their source, so they are only made again
+        when the source changes.
+        """
+        if not shutil.which('gst-launch-1.0'):
+            raise RuntimeError('making proxies requires gst-launch-1.0')
+        pending = {}
+        for path in paths:
+            info = self._media_info(path)
+            height = min(PROXY_HEIGHT, info.height)
+            width = round(info.width * height / info.height / 2) * 2
+            key = json.dumps([file_identity(path), width, height])
+            digest = hashlib.sha256(key.encode('utf-8')).hexdigest()[:24]
+            proxy = os.path.join(self.opts.basedir, 'proxy-{}.mkv'.format(digest))
+            self.proxies[path] = proxy
+            if not os.path.exists(proxy):
+                pending[proxy] = functools.partial(
+                    proxy_command, path, width=width, height=height,
+                    audio=info.audio_rate is not None)
+
+        self.profiler.count('proxies_transcoded', len(pending))
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=os.cpu_count()) as executor:
+            futures = [executor.submit(transcode, command, proxy)
+                       for proxy, command in pending.items()]
+            for future in futures:
+                future.result()
+
+    def emit(self, plan):
+        """Add the layers and clips of a ClipPlan to the timeline."""
+        layers = {}
+        for index in plan.layer_order:
+            layer = self.timeline.append_layer()
+            layer.register_meta_string(
+                GES.MetaFlag.READWRITE, 'video::name', plan.layer_names[index])
+            layers[index] = layer
+
+        assets = [self._get_asset(path) for path in plan.assets]
+        for i in range(len(plan)):
+            clip = layers[plan.layer[i]].add_asset(
+                assets[plan.asset[i]], plan.start[i], plan.inpoint[i],
+                plan.duration[i], GES.TrackType.UNKNOWN)
+            elements = clip.find_track_elements(
+                self.video_track, GES.TrackType.VIDEO, GObject.TYPE_NONE)
+            for element in elements:
+                element.set_child_property("posx", plan.posx[i])
+                element.set_child_property("posy", plan.posy[i])
+                element.set_child_property("width", plan.width[i])
+                element.set_child_property("height", plan.height[i])
+            for description in plan.effects.get(i, ()):
+                clip.add(GES.Effect.new(description))
+            if i in plan.keyframes:
+                self._add_keyframes(elements, plan.keyframes[i])
+
+    def _add_keyframes(self, elements, keyframes):
+        """Drive posx/posy of a clip's video with control bindings."""
+        sources = {}
+        for prop in ('posx', 'posy'):
+            source = GstController.InterpolationControlSource()
+            source.props.mode = GstController.InterpolationMode.NONE
+            sources[prop] = source
+        for timestamp, posx, posy in keyframes:
+            sources['posx'].set(timestamp, posx)
+            sources['posy'].set(timestamp, posy)
+        for element in elements:
+            for prop, source in sources.items():
+                element.set_control_source(source, prop, 'direct-absolute')
+
+    def save(self, path=None, proxies=False):
+        """Save the project to path (default: the OUTPUT option).
+
+        If proxies is True, the preview proxies are attached to their
+        source assets while saving, so players use them instead.  The
+        timeline itself always renders from the original media.
+        """
+        self.timeline.commit_sync()
+        attached = []
+        if proxies:
+            for source, proxy in self.proxies.items():
+                asset, proxy_asset = self._get_asset(source), self._get_asset(proxy)
+                if asset.set_proxy(proxy_asset):
+                    attached.append((asset, proxy_asset))
+        try:
+            self.timeline.save_to_uri(
+                file_to_uri(path or self.opts.project), None, True)
+        finally:
+            for asset, proxy_asset in attached:
+                asset.unproxy(proxy_asset)
+
+    def render(self, output, log=None):
+        """Render the timeline to output with the project's encoding profile.
+
+        Progress is printed as the render runs, and if log is given, it
+        is also written there as JSON lines.
+        """
+        self.timeline.commit_sync()
+        pipeline = GES.Pipeline()
+        pipeline.set_timeline(self.timeline)
+        pipeline.set_render_settings(file_to_uri(output), self.encoding_profile)
+        pipeline.set_mode(GES.PipelineFlags.RENDER)
+
+        progress = RenderProgress(self.timeline.props.duration,
+                                  self.framerate, log)
+        run_pipeline(pipeline, progress.update)
+        progress.finish()
+
+
+def format_time(seconds):
+    seconds = int(seconds)
+    return '{}:{:02d}:{:02d}'.format(
+        seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class RenderProgress:
+    """Report position, speed and ETA of a running render."""
+
+    def __init__(self, duration, framerate, log=None):
+        self.duration = duration
+        self.framerate = framerate
+        self.log = log
+        self.started = time.monotonic()
+        self.position = 0
+
+    def _write_log(self, record):
+        if self.log is not None:
+            self.log.write(json.dumps(record) + '\n')
+            self.log.flush()
+
+    def _stats(self):
+        elapsed = time.monotonic() - self.started
+        seconds = self.position / SECOND
+        frames = seconds * self.framerate[0] / self.framerate[1]
+        speed = seconds / elapsed if elapsed > 0 else 0
+        if speed > 0:
+            eta = (self.duration - self.position) / SECOND / speed
+        else:
+            eta = None
+        return {
+            'elapsed': elapsed,
+            'position': seconds,
+            'duration': self.duration / SECOND,
+            'fps': frames / elapsed if elapsed > 0 else 0,
+            'realtime': speed,
+            'eta': eta,
+        }
+
+    def update(self, pipeline):
+        ok, position = pipeline.query_position(Gst.Format.TIME)
+        if not ok:
             return
+        self.position = position
+        stats = self._stats()
+        print('Rendered {} / {}, {:.1f} fps, {:.2f}x realtime, ETA {}'.format(
+            format_time(stats['position']), format_time(stats['duration']),
+            stats['fps'], stats['realtime'],
+            '?' if stats['eta'] is None else format_time(stats['eta'])))
+        self._write_log(dict(stats, event='progress'))
 
-        layer = self._add_layer('Deskshare')
-        asset = self._get_asset(
-            os.path.join(self.opts.basedir, 'deskshare/deskshare.webm'))
-        width, height = self._constrain(self._get_dimensions(asset),
-                                        (self.slides_width, self.opts.height))
-        duration = asset.props.duration
-        for event in events:
-            start = round(float(event.get('start_timestamp')) * Gst.SECOND)
-            end = round(float(event.get('stop_timestamp')) * Gst.SECOND)
-            # Trim event to duration of video
-            if start > duration: continue
-            end = min(end, duration)
-
-            self._add_clip(layer, asset, start, start, end - start,
-                           0, 0, width, height)
-
-    def add_backdrop(self):
-        if not self.opts.backdrop:
-            return
-        layer = self._add_layer('Backdrop')
-        asset = self._get_asset(self.opts.backdrop)
-        self._add_clip(layer, asset, 0, 0, self.end_time,
-                       0, 0, self.opts.width, self.opts.height)
+    def finish(self):
+        self.position = self.duration
+        stats = self._stats()
+        del stats['eta']
+        print('Rendered {} in {}, {:.1f} fps, {:.2f}x realtime'.format(
+            format_time(stats['duration']), format_time(stats['elapsed']),
+            stats['fps'], stats['realtime']))
+        self._write_log(dict(stats, event='done'))
 
-    def add_credits(self):
-        if not (self.opts.opening_credits or self.opts.closing_credits):
-            return
 
-        layer = self._add_layer('credits')
-        for fname in self.opts.opening_credits:
-            duration = None
-            if ':' in fname:
-                fname, duration = fname.rsplit(':', 1)
-                duration = round(float(duration) * Gst.SECOND)
-
-            asset = self._get_asset(fname)
-            if duration is None:
-                if asset.is_image():
-                    duration = 3 * Gst.SECOND
-                else:
-                    duration = asset.props.duration
-
-                    dims = self._get_dimensions(asset)
-
-            dims = self._get_dimensions(asset)
-            width, height = self._constrain(
-                dims, (self.opts.width, self.opts.height))
-
-            self._add_clip(layer, asset, self.start_time, 0, duration,
-                           0, 0, width, height, trim_end=False)
-            self.opening_length += duration
-
-        closing_length = 0
-        for fname in self.opts.closing_credits:
-            duration = None
-            if ':' in fname:
-                fname, duration = fname.rsplit(':', 1)
-                duration = round(float(duration) * Gst.SECOND)
-
-            asset = self._get_asset(fname)
-            if duration is None:
-                if asset.is_image():
-                    duration = 3 * Gst.SECOND
-                else:
-                    duration = asset.props.duration
-
-                    dims = self._get_dimensions(asset)
-
-            dims = self._get_dimensions(asset)
-            width, height = self._constrain(
-                dims, (self.opts.width, self.opts.height))
-
-            self._add_clip(layer, asset, self.end_time + closing_length, 0,
-                           duration, 0, 0, width, height, trim_end=False)
-            closing_length += duration
-
-    def save(self):
-        self.timeline.commit_sync()
-        self.timeline.save_to_uri(file_to_uri(self.opts.project), None, True)
+PROGRESS_INTERVAL = 5 * SECOND
 
 
-def parse_time(value):
-    """Parse a time interval string into a floating point seconds value.
+def run_pipeline(pipeline, progress=None):
+    """Play a pipeline until EOS, raising an exception on error.
 
-    Supported formats include:
-               ss      (seconds)
-               ss.dd   (seconds with decimals)
-            mm:ss      (minutes and seconds)
-            mm:ss.dd   (minutes and seconds with decimals)
-         hh:mm:ss      (hours, minutes and seconds)
-         hh:mm:ss.dd   (hours, minutes and seconds with decimals)
-      dd:hh:mm:ss      (days,hours, minutes and seconds)
-      dd:hh:mm:ss.dd   (days,hours, minutes and seconds with decimals)
+    If given, progress(pipeline) is called periodically while it runs.
     """
-    # allow an empty value
-    if value == '':
-        return 0
-
-    # seconds should be always 0
-    # minutes should be always 1 ecc.
-    parts = value.split(':')
-    if len(parts) > 4:
-        raise ValueError('The provided time does not respect the supported formats: SS, MM:SS, HH:MM:SS, DD:HH:MM:SS.')
+    bus = pipeline.get_bus()
+    pipeline.set_state(Gst.State.PLAYING)
+    try:
+        while True:
+            msg = bus.timed_pop_filtered(
+                PROGRESS_INTERVAL if progress else Gst.CLOCK_TIME_NONE,
+                Gst.MessageType.EOS | Gst.MessageType.ERROR)
+            if msg is None:
+                progress(pipeline)
+                continue
+            if msg.type == Gst.MessageType.ERROR:
+                error, debug = msg.parse_error()
+                raise RuntimeError('{}: {}'.format(error.message, debug))
+            break
+    finally:
+        pipeline.set_state(Gst.State.NULL)
 
-    parts.reverse()
-    seconds = float(parts[0])
 
-    # minutes (mm:ss)
-    if len(parts) > 1:
-        seconds += int(parts[1]) * 60
+def render_project(project, output):
+    subprocess.run(['ges-launch-1.0', '--load', project, '-o', output],
+                   check=True)
 
-    # hours (hh:mm:ss)
-    if len(parts) > 2:
-        seconds += float(parts[2]) * 3600
 
-    # days (dd:hh:mm:ss)
-    if len(parts) > 3:
-        seconds += float(parts[3]) * 86400
+def concat_segments(pattern, output):
+    """Join MP4 segments matching a glob into one file without re-encoding."""
+    pipeline = Gst.parse_launch(
+        'splitmuxsrc name=src '
+        'src.video ! queue ! h264parse ! mp4mux name=mux ! filesink name=sink '
+        'src.audio_0 ! queue ! aacparse ! mux.')
+    pipeline.get_by_name('src').props.location = pattern
+    pipeline.get_by_name('sink').props.location = output
+    run_pipeline(pipeline)
 
-    return seconds
 
+def segment_bounds(p):
+    """Split the rendered part of the recording into p.opts.segments pieces.
 
-def main(argv):
+    Boundaries are rounded to whole frames, so every segment starts on
+    a frame (and so a keyframe of its own encode).  Webcam videos with
+    a variable frame rate report 0/1, and are split at exact times.
+    """
+    opts = p.opts
+    info = p._media_info(os.path.join(opts.basedir, 'video/webcams.webm'))
+
+    start = opts.start
+    end = opts.end if opts.end is not None else info.duration / SECOND
+    bounds = [start]
+    for i in range(1, opts.segments):
+        t = start + (end - start) * i / opts.segments
+        if info.framerate_num:
+            frame = info.framerate_denom / info.framerate_num
+            t = start + round((t - start) / frame) * frame
+        bounds.append(t)
+    bounds.append(opts.end)
+    return bounds
+
+
+def render_segments(p):
+    """Render the presentation as segments in parallel, then join them.
+
+    Each segment is a separate project covering part of the recording,
+    rendered by its own ges-launch process.  Opening credits are only
+    added to the first segment and closing credits to the last.  The
+    presentation is left with the timeline of the last segment.
+    """
+    opts = p.opts
+    bounds = segment_bounds(p)
+    outdir = tempfile.mkdtemp(
+        prefix='.segments-', dir=os.path.dirname(os.path.abspath(opts.render)))
+    try:
+        jobs = []
+        for i in range(opts.segments):
+            part = copy.copy(opts)
+            part.start, part.end = bounds[i], bounds[i + 1]
+            if i > 0:
+                part.opening_credits = []
+            if i < opts.segments - 1:
+                part.closing_credits = []
+            part.project = os.path.join(outdir, 'part{:04d}.xges'.format(i))
+            p.set_window(part)
+            p.save()
+            jobs.append((part.project,
+                         os.path.join(outdir, 'part{:04d}.mp4'.format(i))))
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=opts.render_jobs) as executor:
+            futures = [executor.submit(render_project, project, output)
+                       for project, output in jobs]
+            for future in futures:
+                future.result()
+        concat_segments(os.path.join(outdir, 'part*.mp4'), opts.render)
+    finally:
+        shutil.rmtree(outdir)
+
+
+def parse_args(argv):
+    """Parse and check the command line arguments (without argv[0])."""
     parser = argparse.ArgumentParser(description='convert a BigBlueButton presentation into a GES project')
     parser.add_argument('--start', metavar='TIME', type=parse_time, default=0,
                         help='Start point in the recording (seconds, or mm:ss, hh:mm:ss, dd:hh:mm:ss)')
     parser.add_argument('--end', metavar='TIME', type=parse_time, default=None,
                         help='End point in the recording')
+    parser.add_argument('--split-every', metavar='TIME', type=parse_time,
+                        default=None,
+                        help='Save a separate project for every TIME of the recording')
+    parser.add_argument('--split-at', metavar='TIME', type=parse_time,
+                        action='append', default=[],
+                        help='Also start a new project at TIME (may be repeated)')
     parser.add_argument('--width', metavar='WIDTH', type=int, default=1920,
                         help='Video width')
     parser.add_argument('--height', metavar='HEIGHT', type=int, default=1080,
@@ -461,15 +590,252 @@ def main(argv):
                         help='File to use as closing credits (may be repeated)')
     parser.add_argument('--annotations', action='store_true', default=False,
                         help='Add annotations to slides (requires inkscape)')
+    parser.add_argument('--rasterize-annotations', action='store_true',
+                        default=False,
+                        help='Convert annotations to PNG images before rendering '
+                        '(requires rsvg-convert or inkscape)')
+    parser.add_argument('--flatten', action='store_true', default=False,
+                        help='Combine backdrop, slides and annotations into a '
+                        'single image for each interval (requires rsvg-convert '
+                        'or inkscape)')
+    parser.add_argument('--cursor-mode', choices=('clips', 'keyframes'),
+                        default='clips',
+                        help='Add a clip for every cursor movement, or animate '
+                        'a single clip with keyframes')
+    parser.add_argument('--cursor-resolution', metavar='SECONDS', type=float,
+                        default=0,
+                        help='Ignore cursor movements closer together than this')
+    parser.add_argument('--compact', action='store_true', default=False,
+                        help='Merge adjacent clips showing the same thing, and '
+                        'remove empty or hidden clips')
+    parser.add_argument('--proxies', action='store_true', default=False,
+                        help='Make low resolution proxies of the webcam and '
+                        'deskshare videos for smooth previewing and editing')
+    parser.add_argument('--dry-run', action='store_true', default=False,
+                        help='Write the planned clips to OUTPUT as JSON ("-" '
+                        'for standard output) instead of a GES project')
+    parser.add_argument('--discovery-jobs', metavar='N', type=int,
+                        default=os.cpu_count() or 4,
+                        help='Number of assets to discover in parallel')
+    parser.add_argument('--media-cache', metavar='FILE', type=str, default=None,
+                        help='Cache of discovered media information '
+                        '(default: PRESENTATION-DIR/.media-info.json)')
+    parser.add_argument('--no-media-cache', dest='media_cache',
+                        action='store_const', const='',
+                        help='Do not cache discovered media information')
+    parser.add_argument('--profile', metavar='FILE', type=str, default=None,
+                        help='Write timings and counts for each stage of building '
+                        'the project to FILE as JSON ("-" for standard output)')
+    parser.add_argument('--render', metavar='FILE', type=str, default=None,
+                        help='Render the project to an MP4 file')
+    parser.add_argument('--render-log', metavar='FILE', type=str, default=None,
+                        help='Write render progress and timing to FILE as JSON lines')
+    parser.add_argument('--segments', metavar='N', type=int, default=1,
+                        help='Render in N segments in parallel, then join them')
+    parser.add_argument('--render-jobs', metavar='N', type=int, default=None,
+                        help='Number of segments to render at once '
+                        '(default: all of them)')
     parser.add_argument('basedir', metavar='PRESENTATION-DIR', type=str,
                         help='directory containing BBB presentation assets')
     parser.add_argument('project', metavar='OUTPUT', type=str,
                         help='output filename for GES project')
-    opts = parser.parse_args(argv[1:])
-    Gst.init(None)
-    GES.init()
-    p = Presentation(opts)
-    p.save()
+    opts = parser.parse_args(argv)
+    if opts.media_cache is None:
+        opts.media_cache = os.path.join(opts.basedir, '.media-info.json')
+    elif opts.media_cache == '':
+        opts.media_cache = None
+    if opts.segments < 1:
+        parser.error('--segments must be at least 1')
+    if opts.segments > 1 and opts.render is None:
+        parser.error('--segments requires --render')
+    if opts.segments > 1 and not opts.render.endswith('.mp4'):
+        parser.error('--segments can only render MP4 files')
+    if opts.render_jobs is None:
+        opts.render_jobs = opts.segments
+    if opts.split_every is not None and opts.split_every <= 0:
+        parser.error('--split-every must be positive')
+    if opts.dry_run and opts.render is not None:
+        parser.error('--dry-run cannot be combined with --render')
+    if opts.segments > 1 and (opts.split_every is not None or opts.split_at):
+        parser.error('--segments cannot be combined with --split-every or --split-at')
+    return opts
+
+
+def preview_project(path):
+    """Return the name of the project using the proxies made by --proxies."""
+    root, ext = os.path.splitext(path)
+    return '{}.preview{}'.format(root, ext)
+
+
+def numbered(path, index, count):
+    """Insert a part number before the extension of path."""
+    root, ext = os.path.splitext(path)
+    return '{}-{:0{}d}{}'.format(root, index, max(2, len(str(count))), ext)
+
+
+def split_parts(opts, duration):
+    """Return a copy of opts for each part given by --split-every and --split-at.
+
+    duration is the length of the recording in seconds, used when no
+    end point is given.  Each part gets its own numbered project and
+    render output, and the same credits.
+    """
+    start = opts.start
+    end = opts.end if opts.end is not None else duration
+    points = {t for t in opts.split_at if start < t < end}
+    if opts.split_every:
+        t = start + opts.split_every
+        while t < end:
+            points.add(t)
+            t += opts.split_every
+    bounds = [start] + sorted(points) + [end]
+
+    parts = []
+    for i in range(len(bounds) - 1):
+        part = copy.copy(opts)
+        part.start, part.end = bounds[i], bounds[i + 1]
+        part.project = numbered(opts.project, i + 1, len(bounds) - 1)
+        if opts.render is not None:
+            part.render = numbered(opts.render, i + 1, len(bounds) - 1)
+        parts.append(part)
+    return parts
+
+
+def build(opts):
+    """Create, save and optionally render the project described by opts.
+
+    With --split-every or --split-at, the recording is loaded once and
+    a project is saved (and rendered) for each part.  init_gstreamer()
+    must already have been called, except for --dry-run.  Returns the
+    Presentation, or the Planner for --dry-run.
+    """
+    if opts.dry_run:
+        return dry_run(opts)
+    mark = time.monotonic()
+    if opts.split_every is None and not opts.split_at:
+        p = Presentation(opts)
+        parts = [opts]
+    else:
+        p = Presentation(opts, layout=False)
+        parts = split_parts(opts, p.planner.end_time / SECOND)
+
+    log = None
+    if opts.render is not None and opts.render_log is not None:
+        log = open(opts.render_log, 'w')
+    try:
+        for part in parts:
+            if part is not opts:
+                p.set_window(part)
+            with p.profiler.stage('save'):
+                p.save()
+                if p.proxies:
+                    p.save(preview_project(part.project), proxies=True)
+            if opts.render is None:
+                continue
+
+            if log is not None:
+                log.write(json.dumps({'event': 'build', 'project': part.project,
+                                      'elapsed': time.monotonic() - mark}) + '\n')
+            if opts.segments > 1:
+                render_start = time.monotonic()
+                duration = p.timeline.props.duration
+                render_segments(p)
+                if log is not None:
+                    log.write(json.dumps({
+                        'event': 'done',
+                        'elapsed': time.monotonic() - render_start,
+                        'duration': duration / SECOND,
+                        'segments': opts.segments}) + '\n')
+            else:
+                p.render(part.render, log)
+            mark = time.monotonic()
+    finally:
+        if log is not None:
+            log.close()
+    if len(parts) > 1:
+        print('Saved {} projects'.format(len(parts)))
+
+    write_profile(p.profiler, opts.profile)
+    return p
+
+
+def write_profile(profiler, path):
+    if path is None:
+        return
+    report = json.dumps(profiler.report(), indent=2)
+    if path == '-':
+        print(report)
+    else:
+        with open(path, 'w') as fp:
+            fp.write(report + '\n')
+
+
+def dry_run_media(media_cache):
+    """Return a function looking up the MediaInfo of a file for --dry-run.
+
+    Files are looked up in the media cache, then images are measured
+    from their headers.  Only files that are neither are discovered
+    with GStreamer, which is imported on first use.
+    """
+    def media(path):
+        info = media_cache.get(path)
+        if info is not None:
+            return info
+        dims = image_dimensions(path)
+        if dims is not None:
+            return MediaInfo(
+                width=dims[0], height=dims[1], duration=None,
+                framerate_num=None, framerate_denom=None,
+                audio_rate=None, audio_channels=None, is_image=True)
+        if GES is None:
+            init_gstreamer()
+        info = asset_media_info(
+            GES.UriClipAsset.request_sync(file_to_uri(path)))
+        media_cache.put(path, info)
+        return info
+    return media
+
+
+def dry_run(opts):
+    """Write the clip plan for opts as JSON, without building a project.
+
+    No annotation or flattened images are made, and with a warm media
+    cache GStreamer isn't needed at all.  With --split-every or
+    --split-at, a plan is written for each part.  Returns the Planner.
+    """
+    profiler = Profiler()
+    media_cache = MediaInfoCache(opts.media_cache)
+    planner = Planner(opts, dry_run_media(media_cache), profiler, dry_run=True)
+    with profiler.stage('load'):
+        planner.set_window(opts)
+        planner.load()
+    if opts.split_every is None and not opts.split_at:
+        parts = [opts]
+    else:
+        parts = split_parts(opts, planner.end_time / SECOND)
+
+    for part in parts:
+        if opts.project == '-':
+            # Keep anything printed while planning out of the JSON
+            with contextlib.redirect_stdout(sys.stderr):
+                planner.set_window(part)
+                plan = planner.plan()
+            sys.stdout.write(plan.to_json())
+        else:
+            planner.set_window(part)
+            plan = planner.plan()
+            with open(part.project, 'w') as fp:
+                fp.write(plan.to_json())
+    media_cache.save()
+    write_profile(profiler, opts.profile)
+    return planner
+
+
+def main(argv):
+    opts = parse_args(argv[1:])
+    if not opts.dry_run:
+        init_gstreamer()
+    build(opts)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,115 @@
+"""Persistent cache of discovered media stream information.
+
+GStreamer discovery of the webcam and deskshare videos is slow, and
+make-xges.py is often run several times over the same recording.  The
+stream information it needs for laying out the project is stored in a
+JSON file keyed by each file's path, size and modification time, so an
+entry is ignored as soon as the file changes.
+
+This module must not depend on GStreamer.
+"""
+
+import collections
+import json
+import os
+import struct
+
+
+MediaInfo = collections.namedtuple('MediaInfo', [
+    'width', 'height', 'duration', 'framerate_num', 'framerate_denom',
+    'audio_rate', 'audio_channels', 'is_image'])
+
+
+class MediaInfoCache:
+
+    def __init__(self, path):
+        self.path = path
+        self._dirty = False
+        self._entries = {}
+        if path is None:
+            return
+        try:
+            with open(path, 'r') as fp:
+                self._entries = json.load(fp)['files']
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError):
+            # A corrupt cache is simply rebuilt
+            self._dirty = True
+
+    @staticmethod
+    def _identity(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+
+    def get(self, path):
+        """Return the cached MediaInfo for path, or None if missing or stale."""
+        key = os.path.realpath(path)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        try:
+            size, mtime = self._identity(key)
+        except OSError:
+            return None
+        if entry['size'] != size or entry['mtime_ns'] != mtime:
+            return None
+        return MediaInfo(**entry['info'])
+
+    def put(self, path, info):
+        key = os.path.realpath(path)
+        size, mtime = self._identity(key)
+        self._entries[key] = {
+            'size': size,
+            'mtime_ns': mtime,
+            'info': info._asdict(),
+        }
+        self._dirty = True
+
+    def save(self):
+        if self.path is None or not self._dirty:
+            return
+        # Forget files that have changed or no longer exist
+        entries = {}
+        for key, entry in self._entries.items():
+            try:
+                size, mtime = self._identity(key)
+            except OSError:
+                continue
+            if entry['size'] == size and entry['mtime_ns'] == mtime:
+                entries[key] = entry
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump({'version': 1, 'files': entries}, fp, sort_keys=True)
+        os.replace(tmp, self.path)
+        self._entries = entries
+        self._dirty = False
+
+
+def image_dimensions(path):
+    """Read the (width, height) of a PNG or JPEG image from its header.
+
+    Returns None for other formats or unreadable files.
+    """
+    try:
+        with open(path, 'rb') as fp:
+            header = fp.read(24)
+            if header.startswith(b'\x89PNG\r\n\x1a\n') and header[12:16] == b'IHDR':
+                return struct.unpack('>II', header[16:24])
+            if not header.startswith(b'\xff\xd8'):
+                return None
+            # Walk the JPEG segments looking for a start of frame
+            fp.seek(2)
+            while True:
+                marker = fp.read(2)
+                if len(marker) < 2 or marker[0] != 0xff:
+                    return None
+                if marker[1] in (0xd8, 0x01) or 0xd0 <= marker[1] <= 0xd7:
+                    continue
+                length = struct.unpack('>H', fp.read(2))[0]
+                if 0xc0 <= marker[1] <= 0xcf and marker[1] not in (0xc4, 0xc8, 0xcc):
+                    height, width = struct.unpack('>xHH', fp.read(5))
+                    return width, height
+                fp.seek(length - 2, os.SEEK_CUR)
+    except (OSError, struct.error):
+        return None
@@ -0,0 +1,881 @@
+"""Lay out a BigBlueButton recording as a plan of clips.
+
+This is the layout and timing logic of make-xges.py: which slides,
+annotations, cursor positions and videos are shown, where and when.
+The result is a ClipPlan, which make-xges.py turns into a GES
+timeline, or writes out as JSON with --dry-run.
+
+This module must not depend on GStreamer.  Information about media
+files comes from a function supplied by the caller, and times are
+integer nanoseconds, as in GStreamer.
+"""
+
+import array
+import base64
+import bisect
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import time
+import xml.etree.ElementTree as ET
+
+from mediainfo import image_dimensions
+from recording import ShapesDocument, iter_cursor_events
+from sweep import locate, segment
+
+# GStreamer's content detection doesn't work well with ElementTree's
+# automatically assigned namespace prefixes.
+ET.register_namespace("", "http://www.w3.org/2000/svg")
+
+
+# Nanoseconds per second, the same as Gst.SECOND
+SECOND = 1000000000
+
+SlideInfo = collections.namedtuple('SlideInfo', ['id', 'width', 'height', 'start', 'end'])
+AnnotationFrame = collections.namedtuple('AnnotationFrame', ['info', 'start', 'end', 'path'])
+FlatFrame = collections.namedtuple('FlatFrame', ['start', 'end', 'path'])
+CursorEvent = collections.namedtuple('CursorEvent', ['x', 'y', 'start'])
+
+
+def write_atomic(path, data):
+    """Write data to path, so the file is either complete or absent."""
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as fp:
+        fp.write(data)
+    os.replace(tmp, path)
+
+
+def rasterizer_command():
+    """Return a function building the command line to rasterize an SVG."""
+    if shutil.which('rsvg-convert'):
+        return lambda svg, png, width, height: [
+            'rsvg-convert', '--format=png', '--width={}'.format(width),
+            '--height={}'.format(height), '--output={}'.format(png), svg]
+    if shutil.which('inkscape'):
+        return lambda svg, png, width, height: [
+            'inkscape', '--export-type=png', '--export-filename={}'.format(png),
+            '--export-width={}'.format(width),
+            '--export-height={}'.format(height), svg]
+    raise RuntimeError('rasterizing annotations requires rsvg-convert or inkscape')
+
+
+def rasterize(command, svg, png, width, height):
+    tmp = '{}.{}.tmp.png'.format(png, os.getpid())
+    subprocess.run(command(svg, tmp, width, height), check=True,
+                   stdout=subprocess.DEVNULL)
+    os.replace(tmp, png)
+
+
+IMAGE_TYPES = {
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.svg': 'image/svg+xml',
+}
+
+
+def data_uri(path):
+    mime_type = IMAGE_TYPES.get(os.path.splitext(path)[1].lower(),
+                                'application/octet-stream')
+    with open(path, 'rb') as fp:
+        data = base64.b64encode(fp.read()).decode('ascii')
+    return 'data:{};base64,{}'.format(mime_type, data)
+
+
+def file_identity(path):
+    st = os.stat(path)
+    return [os.path.realpath(path), st.st_size, st.st_mtime_ns]
+
+
+def _cursor_hidden(pos):
+    # negative positions are used to indicate that no cursor should be
+    # displayed.
+    return pos.x < 0 and pos.y < 0
+
+
+def _contains(outer, inner):
+    """Whether rectangle outer (x, y, width, height) contains inner."""
+    return (outer[0] <= inner[0] and outer[1] <= inner[1] and
+            inner[0] + inner[2] <= outer[0] + outer[2] and
+            inner[1] + inner[3] <= outer[1] + outer[3])
+
+
+def _merge_intervals(intervals):
+    """Sort (start, end) intervals, joining those that touch or overlap."""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _covered(intervals, start, end):
+    """Whether [start, end) lies within one of the merged intervals."""
+    i = bisect.bisect_right(intervals, (start, float('inf'))) - 1
+    return i >= 0 and intervals[i][1] >= end
+
+
+def parse_credit(value):
+    """Split a FILE[:DURATION] credits option into path and duration."""
+    duration = None
+    if ':' in value:
+        value, duration = value.rsplit(':', 1)
+        duration = round(float(duration) * SECOND)
+    return value, duration
+
+
+def parse_xml(path, profiler):
+    """Parse an XML file, counting the time taken against profiler."""
+    start = time.perf_counter()
+    doc = ET.parse(path)
+    profiler.count('xml_parse_time', time.perf_counter() - start)
+    return doc
+
+
+def constrain(dimensions, bounds):
+    """Scale dimensions to fit within bounds, keeping the aspect ratio."""
+    width, height = dimensions
+    max_width, max_height = bounds
+    new_height = round(height * max_width / width)
+    if new_height <= max_height:
+        return max_width, new_height
+    return round(width * max_height / height), max_height
+
+
+class ClipPlan:
+    """The clips of a timeline, stored column-wise in arrays.
+
+    Clip i is on layer layer[i] (an index into layer_names), shows
+    asset asset[i] (an index into assets), and has the given start,
+    inpoint, duration and geometry.  Layers are stacked in the order
+    of layer_order, top first.  keyframes maps a clip to its list of
+    (time, posx, posy) control points, relative to the clip's start,
+    and effects maps a clip to a list of effect descriptions.
+    """
+
+    COLUMNS = ('start', 'inpoint', 'duration', 'posx', 'posy', 'width', 'height')
+
+    def __init__(self):
+        self.layer_names = []
+        self.layer_order = []
+        self.assets = []
+        self.asset_is_image = []
+        self._asset_index = {}
+        self.layer = array.array('H')
+        self.asset = array.array('I')
+        for column in self.COLUMNS:
+            setattr(self, column, array.array('q'))
+        self.keyframes = {}
+        self.effects = {}
+
+    def __len__(self):
+        return len(self.layer)
+
+    def add_layer(self, name, above_previous=False):
+        """Add a layer at the bottom, or just above the bottom layer."""
+        index = len(self.layer_names)
+        self.layer_names.append(name)
+        if above_previous and self.layer_order:
+            self.layer_order.insert(len(self.layer_order) - 1, index)
+        else:
+            self.layer_order.append(index)
+        return index
+
+    def add_clip(self, layer, path, is_image, start, inpoint, duration,
+                 posx, posy, width, height):
+        asset = self._asset_index.get(path)
+        if asset is None:
+            asset = self._asset_index[path] = len(self.assets)
+            self.assets.append(path)
+            self.asset_is_image.append(is_image)
+        self.layer.append(layer)
+        self.asset.append(asset)
+        for column, value in zip(self.COLUMNS, (start, inpoint, duration,
+                                                posx, posy, width, height)):
+            getattr(self, column).append(value)
+        return len(self.layer) - 1
+
+    def geometry(self, i):
+        return self.posx[i], self.posy[i], self.width[i], self.height[i]
+
+    def select(self, keep):
+        """Keep only the clips whose index is in the sorted list keep."""
+        renumber = {old: new for new, old in enumerate(keep)}
+        self.layer = array.array('H', (self.layer[i] for i in keep))
+        self.asset = array.array('I', (self.asset[i] for i in keep))
+        for column in self.COLUMNS:
+            values = getattr(self, column)
+            setattr(self, column, array.array('q', (values[i] for i in keep)))
+        self.keyframes = {renumber[i]: v for i, v in self.keyframes.items()
+                          if i in renumber}
+        self.effects = {renumber[i]: v for i, v in self.effects.items()
+                        if i in renumber}
+
+    def to_json(self):
+        """Return the plan as JSON, with times in milliseconds.
+
+        Layers are listed top first, and each clip is on a line of its
+        own so that plans from different runs are easy to diff.
+        """
+        def ms(t):
+            return t / 1000000
+
+        rows = []
+        for i in range(len(self)):
+            row = [self.layer_names[self.layer[i]], self.assets[self.asset[i]],
+                   ms(self.start[i]), ms(self.inpoint[i]), ms(self.duration[i]),
+                   self.posx[i], self.posy[i], self.width[i], self.height[i]]
+            extra = {}
+            if i in self.keyframes:
+                extra['keyframes'] = [[ms(t), x, y] for t, x, y in self.keyframes[i]]
+            if i in self.effects:
+                extra['effects'] = self.effects[i]
+            if extra:
+                row.append(extra)
+            rows.append(json.dumps(row))
+        return '{{\n "layers": {},\n "columns": {},\n "clips": [\n  {}\n ]\n}}\n'.format(
+            json.dumps([self.layer_names[i] for i in self.layer_order]),
+            json.dumps(['layer', 'asset'] + list(self.COLUMNS)),
+            ',\n  '.join(rows))
+
+
+class Planner:
+    """Work out the clips for a presentation.
+
+    media(path) must return the MediaInfo of a file.  set_window()
+    must be called before load() and plan().  If dry_run is true, no
+    annotation or flattened images are written, but the plan refers to
+    the files that would have been.
+    """
+
+    def __init__(self, opts, media, profiler, dry_run=False):
+        self.opts = opts
+        self.media = media
+        self.profiler = profiler
+        self.dry_run = dry_run
+        self._cursor_events = None
+
+    def set_window(self, opts):
+        """Use the start and end points and credits of opts for the next plan.
+
+        After load(), opts may only differ in the start and end points,
+        credits and output files, and must lie within the original
+        start and end.
+        """
+        self.opts = opts
+        self.cam_width = round(opts.width * opts.webcam_size / 100)
+        self.slides_width = opts.width - self.cam_width
+        self.start_time = round(opts.start * SECOND)
+        if opts.end is None:
+            self.end_time = self.media(
+                os.path.join(opts.basedir, 'video/webcams.webm')).duration
+        else:
+            self.end_time = round(opts.end * SECOND)
+
+    def _get_dimensions(self, path):
+        info = self.media(path)
+        return (info.width, info.height)
+
+    def load(self):
+        """Read the recording and make any images it needs.
+
+        Returns the paths of every file the project may use.
+        """
+        paths = [os.path.join(self.opts.basedir, 'video/webcams.webm')]
+        for fname in self.opts.opening_credits + self.opts.closing_credits:
+            paths.append(parse_credit(fname)[0])
+
+        self._load_slides()
+        if self.opts.annotations:
+            self._write_annotations()
+            if self.opts.rasterize_annotations:
+                self._rasterize_annotations()
+            paths.append('dot.png')
+        self._shapes_doc.close()
+        if self.opts.flatten:
+            self._flatten()
+            paths.extend(frame.path for frame in self.flat_frames)
+        else:
+            paths.extend(path for info, path in self.visible_slides)
+            if self.opts.annotations:
+                paths.extend(frame.path for frame in self.annotation_frames)
+
+        self.videos = [os.path.join(self.opts.basedir, 'video/webcams.webm')]
+        self._load_deskshare()
+        if len(self.deskshare_events) > 0:
+            self.videos.append(os.path.join(self.opts.basedir, 'deskshare/deskshare.webm'))
+        paths.extend(self.videos[1:])
+
+        if self.opts.backdrop:
+            paths.append(self.opts.backdrop)
+        return paths
+
+    def _load_slides(self):
+        start = time.perf_counter()
+        doc = ShapesDocument(os.path.join(self.opts.basedir, 'shapes.svg'),
+                             shapes=self.opts.annotations)
+        self.profiler.count('xml_parse_time', time.perf_counter() - start)
+        self._shapes_doc = doc
+        self.slides = {}
+        # (start, end, SlideInfo) for every slide
+        self.slide_intervals = []
+        # (SlideInfo, path) for slides to be shown in the project
+        self.visible_slides = []
+        for img in doc.slides:
+            if img.cls != 'slide':
+                continue
+            info = SlideInfo(
+                id=img.id,
+                width=int(img.width),
+                height=int(img.height),
+                start=round(img.start * SECOND),
+                end=round(img.end * SECOND),
+            )
+            self.slides[info.id] = info
+            self.slide_intervals.append((info.start, info.end, info))
+
+            # Don't bother creating an asset for out of range slides
+            if info.end < self.start_time or info.start > self.end_time:
+                continue
+
+            path = img.href
+            # If this is a "deskshare" slide, don't show anything
+            if path.endswith('/deskshare.png'):
+                continue
+
+            self.visible_slides.append(
+                (info, os.path.join(self.opts.basedir, path)))
+
+    def _write_annotations(self):
+        """Write an SVG file for each distinct set of annotations."""
+        self.annotation_frames = []
+        doc = self._shapes_doc
+        for canvas in doc.canvases:
+            info = self.slides[canvas.image]
+            shapes = []
+            for index, record in enumerate(canvas.shapes):
+                timestamp = round(record.timestamp * SECOND)
+                undo = round(record.undo * SECOND)
+                if undo < 0:
+                    undo = info.end
+
+                # Clip timestamps to slide visibility
+                start = min(max(timestamp, info.start), info.end)
+                end = min(max(undo, info.start), info.end)
+
+                # Don't bother creating annotations for out of range times
+                if end < self.start_time or start > self.end_time:
+                    continue
+
+                # Only the shapes of one canvas are held in memory
+                shape = doc.element(record)
+                shape.set('style', shape.get('style').replace(
+                    'visibility:hidden;', ''))
+                shapes.append((start, end, (index, shape)))
+
+            for begin, end, items in segment(shapes):
+                svg = ET.Element('{http://www.w3.org/2000/svg}svg')
+                svg.set('version', '1.1')
+                svg.set('width', '{}px'.format(info.width))
+                svg.set('height', '{}px'.format(info.height))
+                svg.set('viewBox', '0 0 {} {}'.format(info.width, info.height))
+
+                # We want to discard all but the last version of each
+                # shape ID, which requires two passes.
+                shape_index = {}
+                for index, shape in items:
+                    shape_index[shape.get('shape')] = index
+                for index, shape in items:
+                    if shape_index[shape.get('shape')] != index: continue
+                    svg.append(shape)
+
+                # Name the file after its content, so identical frames
+                # share a file and an asset, and unchanged files aren't
+                # rewritten on later runs.
+                data = ET.tostring(svg, xml_declaration=True)
+                digest = hashlib.sha256(data).hexdigest()[:24]
+                path = os.path.join(
+                    self.opts.basedir, 'annotations-{}.svg'.format(digest))
+                if not self.dry_run and not os.path.exists(path):
+                    write_atomic(path, data)
+                    self.profiler.count('annotation_files')
+
+                self.annotation_frames.append(AnnotationFrame(
+                    info, begin, end, path))
+
+    def _rasterize_annotations(self):
+        """Convert the annotation frames to PNGs at their final size.
+
+        Each rasterizer runs as a separate process, with one per CPU.
+        The PNG names include the SVG content hash and size, so they
+        are only regenerated when something changes.
+        """
+        pending = {}
+        frames = []
+        for frame in self.annotation_frames:
+            width, height = constrain(
+                (frame.info.width, frame.info.height),
+                (self.slides_width, self.opts.height))
+            png = '{}-{}x{}.png'.format(
+                os.path.splitext(frame.path)[0], width, height)
+            if not os.path.exists(png):
+                pending[png] = (frame.path, width, height)
+            frames.append(frame._replace(path=png))
+
+        self._rasterize(pending)
+        self.annotation_frames = frames
+
+    def _rasterize(self, pending):
+        """Run the rasterizer for each {png: (svg, width, height)} in parallel."""
+        if self.dry_run or not pending:
+            return
+        command = rasterizer_command()
+        self.profiler.count('images_rasterized', len(pending))
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=os.cpu_count()) as executor:
+            futures = [executor.submit(rasterize, command, svg, png, width, height)
+                       for png, (svg, width, height) in pending.items()]
+            for future in futures:
+                future.result()
+
+    def _flatten(self):
+        """Precompose backdrop, slide and annotations into still frames.
+
+        A full frame image is made for every interval over which the
+        slide and its annotations don't change, so the compositor has
+        one input instead of three.  Images are named after a hash of
+        their inputs and reused by later runs.
+        """
+        annotations = collections.defaultdict(list)
+        if self.opts.annotations:
+            for frame in self.annotation_frames:
+                annotations[frame.info.id].append(frame)
+
+        backdrop = None
+        if self.opts.backdrop:
+            backdrop = file_identity(self.opts.backdrop)
+        uris = {}
+        pending = {}
+        self.flat_frames = []
+        for info, path in self.visible_slides:
+            dims = image_dimensions(path) or self._get_dimensions(path)
+            width, height = constrain(
+                dims, (self.slides_width, self.opts.height))
+
+            # Split the slide's time into pieces with and without
+            # annotations.
+            pieces = []
+            t = info.start
+            for frame in sorted(annotations[info.id], key=lambda f: f.start):
+                if frame.start > t:
+                    pieces.append((t, frame.start, None))
+                pieces.append((frame.start, frame.end, frame.path))
+                t = frame.end
+            if t < info.end:
+                pieces.append((t, info.end, None))
+
+            for start, end, annotation in pieces:
+                key = json.dumps([self.opts.width, self.opts.height, backdrop,
+                                  file_identity(path), width, height, annotation])
+                digest = hashlib.sha256(key.encode('utf-8')).hexdigest()[:24]
+                png = os.path.join(self.opts.basedir, 'flat-{}.png'.format(digest))
+                self.flat_frames.append(FlatFrame(start, end, png))
+                if self.dry_run or png in pending or os.path.exists(png):
+                    continue
+
+                svg = ET.Element('{http://www.w3.org/2000/svg}svg')
+                svg.set('version', '1.1')
+                svg.set('width', '{}px'.format(self.opts.width))
+                svg.set('height', '{}px'.format(self.opts.height))
+                svg.set('viewBox', '0 0 {} {}'.format(self.opts.width, self.opts.height))
+                layers = [(path, width, height)]
+                if backdrop is not None:
+                    layers.insert(0, (self.opts.backdrop, self.opts.width, self.opts.height))
+                if annotation is not None:
+                    layers.append((annotation, width, height))
+                for layer_path, layer_width, layer_height in layers:
+                    if layer_path not in uris:
+                        uris[layer_path] = data_uri(layer_path)
+                    img = ET.SubElement(svg, '{http://www.w3.org/2000/svg}image')
+                    img.set('x', '0')
+                    img.set('y', '0')
+                    img.set('width', str(layer_width))
+                    img.set('height', str(layer_height))
+                    img.set('preserveAspectRatio', 'none')
+                    img.set('{http://www.w3.org/1999/xlink}href', uris[layer_path])
+                svg_path = '{}.{}.svg'.format(png, os.getpid())
+                with open(svg_path, 'wb') as fp:
+                    fp.write(ET.tostring(svg, xml_declaration=True))
+                pending[png] = (svg_path, self.opts.width, self.opts.height)
+
+        try:
+            self._rasterize(pending)
+        finally:
+            for svg_path, width, height in pending.values():
+                os.unlink(svg_path)
+
+    def _load_cursor(self):
+        parse_start = time.perf_counter()
+        resolution = round(self.opts.cursor_resolution * SECOND)
+        events = []
+        for timestamp, x, y in iter_cursor_events(
+                os.path.join(self.opts.basedir, 'cursor.xml')):
+            start = round(timestamp * SECOND)
+            pos = CursorEvent(x, y, start)
+            # Fold visible events closer together than the requested
+            # resolution into the previous one.
+            if (events and start - events[-1].start < resolution and
+                    not _cursor_hidden(pos) and not _cursor_hidden(events[-1])):
+                events[-1] = pos._replace(start=events[-1].start)
+            else:
+                events.append(pos)
+        self.profiler.count('xml_parse_time', time.perf_counter() - parse_start)
+        return events
+
+    def _load_deskshare(self):
+        doc = parse_xml(os.path.join(self.opts.basedir, 'deskshare.xml'),
+                        self.profiler)
+        self.deskshare_events = [
+            (round(float(event.get('start_timestamp')) * SECOND),
+             round(float(event.get('stop_timestamp')) * SECOND))
+            for event in doc.iterfind('./event')]
+
+    def plan(self):
+        """Return the ClipPlan for the current window."""
+        self._plan = ClipPlan()
+        # Offset for the opening credits
+        self.opening_length = 0
+        stages = [
+            ('add_credits', self.add_credits),
+            ('add_webcams', self.add_webcams),
+            ('add_slides', lambda: self.add_slides(self.opts.annotations)),
+            ('add_deskshare', self.add_deskshare),
+            ('add_backdrop', self.add_backdrop),
+        ]
+        if self.opts.compact:
+            stages.append(('compact', self.compact))
+        for name, stage in stages:
+            with self.profiler.stage(name):
+                stage()
+        return self._plan
+
+    def _add_layer(self, name, above_previous=False):
+        return self._plan.add_layer(name, above_previous)
+
+    def _add_clip(self, layer, path, start, inpoint, duration,
+                  posx, posy, width, height, trim_end=True, is_image=None):
+        if trim_end:
+            # Skip clips entirely after the end point
+            if start > self.end_time:
+                return
+            # Truncate clips that go past the end point
+            duration = min(duration, self.end_time - start)
+
+        # Skip clips entirely before the start point
+        if start + duration < self.start_time:
+            return
+        if is_image is None:
+            is_image = self.media(path).is_image
+        # Rewrite start, inpoint, and duration to account for time skip
+        start -= self.start_time
+        if start < 0:
+            duration += start
+            if not is_image:
+                inpoint += -start
+            start = 0
+
+        # Offset start point by the length of the opening credits
+        start += self.opening_length
+
+        self.profiler.count_clip(self._plan.layer_names[layer])
+        return self._plan.add_clip(layer, path, is_image, start, inpoint,
+                                   duration, posx, posy, width, height)
+
+    def add_webcams(self):
+        layer = self._add_layer('Camera')
+        path = os.path.join(self.opts.basedir, 'video/webcams.webm')
+        dims = self._get_dimensions(path)
+        if self.opts.stretch_webcam or self.opts.crop_webcam:
+            dims = (dims[0] * 16/12, dims[1])
+        width, height = constrain(
+            dims, (self.cam_width, self.opts.height))
+
+        clip = self._add_clip(layer, path, 0, 0, self.media(path).duration,
+                              self.opts.width - width, 0,
+                              width, height, is_image=False)
+
+        if self.opts.crop_webcam and clip is not None:
+            self._plan.effects[clip] = ['aspectratiocrop aspect-ratio=16/9']
+
+    def add_slides(self, with_annotations):
+        layer = self._add_layer('Slides')
+        if self.opts.flatten:
+            # Backdrop and annotations are part of the flattened frames
+            for frame in self.flat_frames:
+                self._add_clip(layer, frame.path, frame.start,
+                               0, frame.end - frame.start,
+                               0, 0, self.opts.width, self.opts.height,
+                               is_image=True)
+            if with_annotations:
+                self.add_cursor()
+            return
+
+        for info, path in self.visible_slides:
+            width, height = constrain(
+                self._get_dimensions(path),
+                (self.slides_width, self.opts.height))
+            self._add_clip(layer, path, info.start, 0, info.end - info.start,
+                           0, 0, width, height, is_image=True)
+
+        # If we're not processing annotations, then we're done.
+        if not with_annotations:
+            return
+
+        self.add_cursor()
+
+        # Above the slides layer
+        layer = self._add_layer('Annotations', above_previous=True)
+        for frame in self.annotation_frames:
+            width, height = constrain(
+                (frame.info.width, frame.info.height),
+                (self.slides_width, self.opts.height))
+            self._add_clip(layer, frame.path, frame.start, 0, frame.end - frame.start,
+                           0, 0, width, height, is_image=True)
+
+    def _cursor_positions(self, events, dot_width, dot_height):
+        """Return the (posx, posy) of the cursor dot for each event.
+
+        The position is None for hidden events and for events that
+        don't fall on a slide.
+        """
+        # Find the slide corresponding to each point in time
+        slides = locate([pos.start for pos in events], self.slide_intervals)
+        positions = []
+        for pos, info in zip(events, slides):
+            if _cursor_hidden(pos) or info is None:
+                positions.append(None)
+                continue
+            width, height = constrain(
+                (info.width, info.height),
+                (self.slides_width, self.opts.height))
+            positions.append((round(width*pos.x - dot_width/2),
+                              round(height*pos.y - dot_height/2)))
+        return positions
+
+    def add_cursor(self):
+        # Above the slides layer
+        layer = self._add_layer('Cursor', above_previous=True)
+        dot_width, dot_height = self._get_dimensions('dot.png')
+        if self._cursor_events is None:
+            self._cursor_events = self._load_cursor()
+        events = self._cursor_events
+        positions = self._cursor_positions(events, dot_width, dot_height)
+
+        if self.opts.cursor_mode == 'keyframes':
+            self._add_cursor_keyframes(layer, events, positions)
+            return
+
+        for i, pos in enumerate(events):
+            if positions[i] is None:
+                continue
+
+            # Show cursor until next event or if it is the last event,
+            # the end of recording.
+            if i + 1 < len(events):
+                end = events[i + 1].start
+            else:
+                end = self.end_time
+
+            posx, posy = positions[i]
+            self._add_clip(layer, 'dot.png', pos.start, 0, end - pos.start,
+                           posx, posy, dot_width, dot_height, is_image=True)
+
+    def _add_cursor_keyframes(self, layer, events, positions):
+        """Add one clip per run of visible cursor events.
+
+        The cursor position within each clip is given by keyframes,
+        rather than creating a clip per event.
+        """
+        dot_width, dot_height = self._get_dimensions('dot.png')
+        # [[(event, position)], end] for each run of visible cursor events
+        runs = []
+        for i, pos in enumerate(events):
+            if positions[i] is None:
+                continue
+            if i + 1 < len(events):
+                end = events[i + 1].start
+            else:
+                end = self.end_time
+            if i > 0 and positions[i - 1] is not None:
+                runs[-1][0].append((pos, positions[i]))
+                runs[-1][1] = end
+            else:
+                runs.append([[(pos, positions[i])], end])
+
+        plan = self._plan
+        for run, end in runs:
+            first, (posx, posy) = run[0]
+            clip = self._add_clip(layer, 'dot.png', first.start, 0, end - first.start,
+                                  posx, posy, dot_width, dot_height, is_image=True)
+            if clip is None or len(run) == 1:
+                continue
+
+            # Keyframe times are relative to the start of the clip,
+            # which may have been trimmed.
+            origin = plan.start[clip] - self.opening_length + self.start_time
+            keyframes = []
+            for pos, (posx, posy) in run:
+                timestamp = max(pos.start - origin, 0)
+                if timestamp > plan.duration[clip]:
+                    break
+                # Events before the start of the clip all land on 0,
+                # where only the last one counts.
+                if keyframes and keyframes[-1][0] == timestamp:
+                    keyframes[-1] = (timestamp, posx, posy)
+                else:
+                    keyframes.append((timestamp, posx, posy))
+            plan.keyframes[clip] = keyframes
+
+    def add_deskshare(self):
+        events = self.deskshare_events
+        if len(events) == 0:
+            return
+
+        layer = self._add_layer('Deskshare')
+        path = os.path.join(self.opts.basedir, 'deskshare/deskshare.webm')
+        width, height = constrain(self._get_dimensions(path),
+                                  (self.slides_width, self.opts.height))
+        duration = self.media(path).duration
+        for start, end in events:
+            # Trim event to duration of video
+            if start > duration: continue
+            end = min(end, duration)
+
+            self._add_clip(layer, path, start, start, end - start,
+                           0, 0, width, height, is_image=False)
+
+    def add_backdrop(self):
+        if not self.opts.backdrop:
+            return
+        layer = self._add_layer('Backdrop')
+        path = self.opts.backdrop
+        if not self.opts.flatten:
+            self._add_clip(layer, path, 0, 0, self.end_time,
+                           0, 0, self.opts.width, self.opts.height)
+            return
+
+        # Only fill in the gaps between flattened frames
+        t = 0
+        for frame in sorted(self.flat_frames):
+            if frame.start > t:
+                self._add_clip(layer, path, t, 0, frame.start - t,
+                               0, 0, self.opts.width, self.opts.height)
+            t = max(t, frame.end)
+        if t < self.end_time:
+            self._add_clip(layer, path, t, 0, self.end_time - t,
+                           0, 0, self.opts.width, self.opts.height)
+
+    def add_credits(self):
+        if not (self.opts.opening_credits or self.opts.closing_credits):
+            return
+
+        layer = self._add_layer('credits')
+        for fname in self.opts.opening_credits:
+            fname, duration = parse_credit(fname)
+            info = self.media(fname)
+            if duration is None:
+                if info.is_image:
+                    duration = 3 * SECOND
+                else:
+                    duration = info.duration
+
+            dims = (info.width, info.height)
+            width, height = constrain(
+                dims, (self.opts.width, self.opts.height))
+
+            self._add_clip(layer, fname, self.start_time, 0, duration,
+                           0, 0, width, height, trim_end=False)
+            self.opening_length += duration
+
+        closing_length = 0
+        for fname in self.opts.closing_credits:
+            fname, duration = parse_credit(fname)
+            info = self.media(fname)
+            if duration is None:
+                if info.is_image:
+                    duration = 3 * SECOND
+                else:
+                    duration = info.duration
+
+            dims = (info.width, info.height)
+            width, height = constrain(
+                dims, (self.opts.width, self.opts.height))
+
+            self._add_clip(layer, fname, self.end_time + closing_length, 0,
+                           duration, 0, 0, width, height, trim_end=False)
+            closing_length += duration
+
+    def compact(self):
+        """Merge and remove redundant clips on every layer.
+
+        Abutting clips of the same asset with contiguous inpoints and
+        the same position and size are merged into one.  Empty clips,
+        and still images hidden behind video on a higher layer, are
+        removed.  Clips with keyframes or effects are left alone.
+        """
+        plan = self._plan
+        by_layer = collections.defaultdict(list)
+        for i in range(len(plan)):
+            by_layer[plan.layer[i]].append(i)
+
+        keep = []
+        # Merged (start, end) intervals covered by video, by geometry
+        occluders = {}
+        for layer in plan.layer_order:
+            kept = []
+            for i in sorted(by_layer[layer], key=lambda i: plan.start[i]):
+                start, duration = plan.start[i], plan.duration[i]
+                is_image = plan.asset_is_image[plan.asset[i]]
+                fixed = i in plan.keyframes or i in plan.effects
+                geometry = plan.geometry(i)
+                if duration <= 0 or (
+                        is_image and not fixed and
+                        any(_contains(rect, geometry) and
+                            _covered(intervals, start, start + duration)
+                            for rect, intervals in occluders.items())):
+                    continue
+
+                if kept and not fixed:
+                    prev = kept[-1]
+                    if (plan.asset[prev] == plan.asset[i] and
+                            prev not in plan.keyframes and prev not in plan.effects and
+                            plan.geometry(prev) == geometry and
+                            plan.start[prev] + plan.duration[prev] == start and
+                            (is_image or plan.inpoint[prev] +
+                             plan.duration[prev] == plan.inpoint[i])):
+                        plan.duration[prev] += duration
+                        continue
+                kept.append(i)
+            keep.extend(kept)
+
+            # Video on this layer hides images on the layers below
+            for i in kept:
+                path = plan.assets[plan.asset[i]]
+                if (plan.asset_is_image[plan.asset[i]] or i in plan.effects or
+                        i in plan.keyframes or self.media(path).width is None):
+                    continue
+                intervals = occluders.setdefault(plan.geometry(i), [])
+                intervals.append((plan.start[i], plan.start[i] + plan.duration[i]))
+            for rect, intervals in occluders.items():
+                occluders[rect] = _merge_intervals(intervals)
+
+        removed = len(plan) - len(keep)
+        plan.select(sorted(keep))
+        self.profiler.count('clips_removed', removed)
+        print('Compacting the timeline removed {} clips'.format(removed))
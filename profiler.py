@@ -0,0 +1,60 @@
+"""Timings and counters for the stages of building a project.
+
+This module must not depend on GStreamer.
+"""
+
+import collections
+import contextlib
+import resource
+import time
+
+
+class Profiler:
+    """Timings and counters for each stage of building a project."""
+
+    COUNTERS = ('assets_requested', 'discovery_time', 'clips',
+                'clips_removed', 'annotation_files', 'images_rasterized',
+                'proxies_transcoded', 'xml_parse_time')
+
+    def __init__(self):
+        self.stages = []
+        self._current = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        record = dict.fromkeys(self.COUNTERS, 0)
+        record['name'] = name
+        record['clips_per_layer'] = collections.Counter()
+        self._current = record
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record['wall_time'] = time.perf_counter() - start
+            # Linux reports this in KiB
+            record['peak_rss_kib'] = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss
+            self.stages.append(record)
+            self._current = None
+
+    def count(self, counter, amount=1):
+        if self._current is not None:
+            self._current[counter] += amount
+
+    def count_clip(self, layer_name):
+        if self._current is not None:
+            self._current['clips'] += 1
+            self._current['clips_per_layer'][layer_name] += 1
+
+    def report(self):
+        totals = dict.fromkeys(self.COUNTERS, 0)
+        totals['wall_time'] = 0
+        clips_per_layer = collections.Counter()
+        for record in self.stages:
+            for key in totals:
+                totals[key] += record[key]
+            clips_per_layer.update(record['clips_per_layer'])
+        totals['clips_per_layer'] = dict(clips_per_layer)
+        totals['peak_rss_kib'] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss
+        return {'stages': self.stages, 'totals': totals}
@@ -0,0 +1,209 @@
+"""Helpers for reading BigBlueButton recording assets.
+
+This module is shared by download.py and make-xges.py, and must not
+depend on GStreamer.
+
+shapes.svg and cursor.xml can be hundreds of megabytes for long,
+whiteboard heavy recordings, so they are read incrementally: elements
+are discarded as soon as the information needed from them has been
+copied into small records.
+"""
+
+import os
+import tempfile
+import xml.etree.ElementTree as ET
+
+
+SVG_NS = '{http://www.w3.org/2000/svg}'
+XLINK_NS = '{http://www.w3.org/1999/xlink}'
+
+
+def parse_time(value):
+    """Parse a time interval string into a floating point seconds value.
+
+    Supported formats include:
+               ss      (seconds)
+               ss.dd   (seconds with decimals)
+            mm:ss      (minutes and seconds)
+            mm:ss.dd   (minutes and seconds with decimals)
+         hh:mm:ss      (hours, minutes and seconds)
+         hh:mm:ss.dd   (hours, minutes and seconds with decimals)
+      dd:hh:mm:ss      (days,hours, minutes and seconds)
+      dd:hh:mm:ss.dd   (days,hours, minutes and seconds with decimals)
+    """
+    # allow an empty value
+    if value == '':
+        return 0
+
+    # seconds should be always 0
+    # minutes should be always 1 ecc.
+    parts = value.split(':')
+    if len(parts) > 4:
+        raise ValueError('The provided time does not respect the supported formats: SS, MM:SS, HH:MM:SS, DD:HH:MM:SS.')
+
+    parts.reverse()
+    seconds = float(parts[0])
+
+    # minutes (mm:ss)
+    if len(parts) > 1:
+        seconds += int(parts[1]) * 60
+
+    # hours (hh:mm:ss)
+    if len(parts) > 2:
+        seconds += float(parts[2]) * 3600
+
+    # days (dd:hh:mm:ss)
+    if len(parts) > 3:
+        seconds += float(parts[3]) * 86400
+
+    return seconds
+
+
+class Slide:
+    """An image element in shapes.svg.
+
+    start and end are the in and out times in seconds, or None for
+    images without timing information.  width and height are kept as
+    the attribute strings.
+    """
+
+    __slots__ = ('id', 'cls', 'href', 'width', 'height', 'start', 'end')
+
+    def __init__(self, elem):
+        self.id = elem.get('id')
+        self.cls = elem.get('class')
+        self.href = elem.get(f'{XLINK_NS}href')
+        self.width = elem.get('width')
+        self.height = elem.get('height')
+        start, end = elem.get('in'), elem.get('out')
+        self.start = float(start) if start is not None else None
+        self.end = float(end) if end is not None else None
+
+
+class Canvas:
+    """An annotation canvas, holding the shapes drawn on one slide."""
+
+    __slots__ = ('id', 'image', 'shapes')
+
+    def __init__(self, elem):
+        self.id = elem.get('id')
+        self.image = elem.get('image')
+        self.shapes = []
+
+
+class Shape:
+    """An annotation shape.
+
+    Only the attributes needed to lay out the annotations are kept in
+    memory.  The shape's XML is spooled to a temporary file, and can
+    be read back with ShapesDocument.element().
+    """
+
+    __slots__ = ('shape', 'timestamp', 'undo', 'tail', 'offset', 'length')
+
+    def __init__(self, elem, offset, length):
+        self.shape = elem.get('shape')
+        self.timestamp = float(elem.get('timestamp'))
+        self.undo = float(elem.get('undo'))
+        self.tail = elem.tail
+        self.offset = offset
+        self.length = length
+
+
+class ShapesDocument:
+    """The slides and annotations of a shapes.svg file.
+
+    slides lists every image in the file, and canvases the top level
+    annotation canvases, both in document order.  If shapes is False,
+    annotation shapes are skipped rather than spooled.
+    """
+
+    def __init__(self, path, shapes=True):
+        self.slides = []
+        self.canvases = []
+        self._spool = tempfile.TemporaryFile() if shapes else None
+        try:
+            self._read(path)
+            if self._spool is not None:
+                self._spool.flush()
+        except BaseException:
+            self.close()
+            raise
+
+    def _read(self, path):
+        stack = []
+        canvas = None
+        for event, elem in ET.iterparse(path, events=('start', 'end')):
+            if event == 'start':
+                stack.append(elem)
+                if (len(stack) == 2 and elem.tag == f'{SVG_NS}g' and
+                        elem.get('class') == 'canvas'):
+                    canvas = Canvas(elem)
+                    self.canvases.append(canvas)
+                continue
+
+            stack.pop()
+            if elem.tag == f'{SVG_NS}image':
+                self.slides.append(Slide(elem))
+            if (len(stack) == 2 and canvas is not None and
+                    elem.tag == f'{SVG_NS}g' and elem.get('class') == 'shape'):
+                if self._spool is not None:
+                    # The tail is kept separately so the XML is well formed
+                    tail, elem.tail = elem.tail, None
+                    data = ET.tostring(elem)
+                    elem.tail = tail
+                    offset = self._spool.tell()
+                    self._spool.write(data)
+                    canvas.shapes.append(Shape(elem, offset, len(data)))
+                stack[-1].remove(elem)
+            elif len(stack) == 1:
+                canvas = None
+                stack[0].remove(elem)
+
+    def element(self, shape):
+        """Return a new Element for shape, as found in the document."""
+        data = os.pread(self._spool.fileno(), shape.length, shape.offset)
+        elem = ET.fromstring(data)
+        elem.tail = shape.tail
+        return elem
+
+    def close(self):
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+
+
+def iter_cursor_events(path):
+    """Yield (timestamp, x, y) for each event in a cursor.xml file.
+
+    Times are in seconds, and positions are fractions of the slide
+    size, with negative values when the cursor is hidden.
+    """
+    stack = []
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            continue
+        stack.pop()
+        if len(stack) == 1 and elem.tag == 'event':
+            x, y = elem.find('./cursor').text.split()
+            yield float(elem.attrib['timestamp']), float(x), float(y)
+            stack[0].remove(elem)
+
+
+def image_hrefs(shapes, start=0, end=None):
+    """Return the set of image paths referenced by a shapes.svg file.
+
+    If a time window is given (in seconds), slides whose in/out
+    interval lies entirely outside of it are skipped.  Images without
+    timing information are always included.
+    """
+    hrefs = set()
+    for img in ShapesDocument(shapes, shapes=False).slides:
+        if img.start is not None and img.end is not None:
+            if img.end < start:
+                continue
+            if end is not None and img.start > end:
+                continue
+        hrefs.add(img.href)
+    return hrefs
@@ -0,0 +1,75 @@
+"""Sweep-line algorithms over time intervals.
+
+Slides, cursor events and annotation shapes all come out of the
+recording in time order, so the interval queries make-xges.py needs
+can be answered with a single pass over sorted boundaries rather than
+an interval tree query per item.
+
+Intervals are given as (begin, end, data) tuples covering the half
+open range [begin, end).  This module must not depend on GStreamer.
+"""
+
+import heapq
+
+
+def locate(times, intervals):
+    """Find the interval containing each of a sequence of times.
+
+    Returns a list with one entry per time: the data of the interval
+    containing that time, or None if there is none.  If several
+    intervals contain a time, the one that started most recently wins.
+
+    This is O((n + m) log m) for n times and m intervals, and is
+    fastest when both are already sorted.
+    """
+    order = sorted(range(len(times)), key=times.__getitem__)
+    intervals = sorted(intervals, key=lambda interval: interval[0])
+    result = [None] * len(times)
+    # Max-heap of started intervals by begin time.  Intervals that have
+    # ended are only removed once they reach the top.
+    active = []
+    next_interval = 0
+    for i in order:
+        t = times[i]
+        while next_interval < len(intervals) and intervals[next_interval][0] <= t:
+            begin, end, data = intervals[next_interval]
+            heapq.heappush(active, (-begin, next_interval, end, data))
+            next_interval += 1
+        while active and active[0][2] <= t:
+            heapq.heappop(active)
+        if active:
+            result[i] = active[0][3]
+    return result
+
+
+def segment(intervals):
+    """Split overlapping intervals at every boundary.
+
+    Returns a sorted list of (begin, end, items) tuples, one for each
+    stretch of time covered by at least one interval, where items is
+    the list of data of the intervals covering it in their original
+    order.  Empty intervals are ignored.
+
+    This gives the same segments as IntervalTree.split_overlaps()
+    followed by merge_overlaps(strict=True).
+    """
+    boundaries = []
+    for index, (begin, end, data) in enumerate(intervals):
+        if begin < end:
+            boundaries.append((begin, 1, index, data))
+            boundaries.append((end, 0, index, data))
+    boundaries.sort(key=lambda b: (b[0], b[1]))
+
+    segments = []
+    active = {}
+    for i, (t, starting, index, data) in enumerate(boundaries):
+        if starting:
+            active[index] = data
+        else:
+            del active[index]
+        # Emit the segment up to the next distinct boundary
+        if i + 1 < len(boundaries) and active:
+            next_t = boundaries[i + 1][0]
+            if next_t > t:
+                segments.append((t, next_t, [active[k] for k in sorted(active)]))
+    return segments
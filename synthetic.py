@@ -0,0 +1,337 @@
+#!/usr/bin/python3
+"""Generate synthetic BigBlueButton recordings for benchmarking.
+
+The generated directory has the same layout as one produced by
+download.py: metadata.xml, shapes.svg with slides and annotation
+canvases, cursor.xml, deskshare.xml, the side files, placeholder slide
+images, and (if GStreamer is available) tiny webcam and deskshare
+videos.
+
+RecordingServer serves such a directory over HTTP the way a BBB
+server does, so download.py can be benchmarked without a real server.
+"""
+
+import argparse
+import email.utils
+import http.server
+import os
+import random
+import struct
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+import zlib
+
+
+SVG = 'http://www.w3.org/2000/svg'
+XLINK = 'http://www.w3.org/1999/xlink'
+
+ET.register_namespace('', SVG)
+ET.register_namespace('xlink', XLINK)
+
+
+def png_data(width, height, colour):
+    """Return a solid colour RGB PNG image."""
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+    row = b'\0' + bytes(colour) * width
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(row * height)) +
+            chunk(b'IEND', b''))
+
+
+def _write(outdir, path, data):
+    path = os.path.join(outdir, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    with open(path, mode) as fp:
+        fp.write(data)
+
+
+def write_webm(path, duration, width, height, audio=True):
+    """Encode a tiny test pattern video of duration seconds with GStreamer."""
+    import gi
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst
+    Gst.init(None)
+    frames = max(1, int(duration))
+    description = (
+        'videotestsrc num-buffers={frames} pattern=ball ! '
+        'video/x-raw,width={width},height={height},framerate=1/1 ! '
+        'vp8enc deadline=1 ! webmmux name=mux ! filesink name=sink'.format(
+            frames=frames, width=width, height=height))
+    if audio:
+        # 8000 samples per buffer at 8kHz: one buffer per second
+        description += (
+            ' audiotestsrc num-buffers={} samplesperbuffer=8000 wave=silence ! '
+            'audio/x-raw,rate=8000,channels=1 ! audioconvert ! vorbisenc ! mux.'
+            .format(frames))
+    pipeline = Gst.parse_launch(description)
+    pipeline.get_by_name('sink').props.location = path
+    pipeline.set_state(Gst.State.PLAYING)
+    msg = pipeline.get_bus().timed_pop_filtered(
+        Gst.CLOCK_TIME_NONE, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    pipeline.set_state(Gst.State.NULL)
+    if msg.type == Gst.MessageType.ERROR:
+        error, debug = msg.parse_error()
+        raise RuntimeError('{}: {}'.format(error.message, debug))
+
+
+def generate(outdir, slides=10, canvases=None, shapes=100, cursor_events=1000,
+             deskshare_events=2, duration=600, slide_size=(320, 240),
+             video=True, placeholder_size=1024 * 1024, seed=0):
+    """Write a synthetic recording to outdir.
+
+    The recording is duration seconds long, with the slides shown one
+    after the other.  Annotation shapes are spread across the first
+    canvases slides (default: all of them).
+
+    If video is False, the webcam and deskshare videos are replaced by
+    placeholder_size bytes of random data, which is enough for
+    benchmarking downloads but not for make-xges.py.
+    """
+    rng = random.Random(seed)
+    os.makedirs(outdir, exist_ok=True)
+    width, height = slide_size
+    if canvases is None:
+        canvases = slides
+
+    _write(outdir, 'metadata.xml',
+           '<recording><meta><name>Synthetic recording</name></meta>'
+           '<playback><duration>{}</duration></playback></recording>\n'.format(
+               duration * 1000))
+    for name in ('panzooms.xml', 'slides_new.xml'):
+        _write(outdir, name, '<recording/>\n')
+    for name in ('presentation_text.json', 'captions.json'):
+        _write(outdir, name, '[]\n')
+
+    # Slides, with every tenth one standing in for a deskshare
+    root = ET.Element('{%s}svg' % SVG, {'version': '1.1'})
+    bounds = sorted(rng.uniform(0, duration) for _ in range(slides - 1))
+    bounds = [0.0] + bounds + [float(duration)]
+    slide_ids = []
+    for i in range(slides):
+        slide_id = 'image{}'.format(i + 1)
+        if i % 10 == 9:
+            href = 'presentation/deskshare/deskshare.png'
+            colour = (0, 0, 0)
+        else:
+            href = 'presentation/deck/slide-{}.png'.format(i + 1)
+            colour = [rng.randrange(256) for _ in range(3)]
+        _write(outdir, href, png_data(width, height, colour))
+        ET.SubElement(root, '{%s}image' % SVG, {
+            'id': slide_id, 'class': 'slide',
+            'in': '{:.1f}'.format(bounds[i]), 'out': '{:.1f}'.format(bounds[i + 1]),
+            '{%s}href' % XLINK: href,
+            'width': str(width), 'height': str(height),
+            'x': '0', 'y': '0', 'style': 'visibility:hidden'})
+        slide_ids.append((slide_id, bounds[i], bounds[i + 1]))
+
+    # Annotation shapes, some of which are later undone or redrawn
+    canvas_elements = {}
+    for index in range(shapes):
+        slide_id, start, end = rng.choice(slide_ids[:max(1, canvases)])
+        canvas = canvas_elements.get(slide_id)
+        if canvas is None:
+            canvas = canvas_elements[slide_id] = ET.SubElement(
+                root, '{%s}g' % SVG, {
+                    'class': 'canvas', 'id': 'canvas' + slide_id[5:],
+                    'image': slide_id, 'display': 'none'})
+        timestamp = rng.uniform(start, end)
+        undo = rng.uniform(timestamp, end) if rng.random() < 0.3 else -1
+        shape = ET.SubElement(canvas, '{%s}g' % SVG, {
+            'class': 'shape', 'id': 'draw{}'.format(index),
+            'shape': 'shape{}'.format(rng.randrange(max(1, shapes // 2))),
+            'timestamp': '{:.1f}'.format(timestamp),
+            'undo': '{:.1f}'.format(undo),
+            'style': 'stroke:#ff0000;stroke-width:2;visibility:hidden;fill:none'})
+        points = ' '.join('{:.1f},{:.1f}'.format(rng.uniform(0, width),
+                                                 rng.uniform(0, height))
+                          for _ in range(5))
+        ET.SubElement(shape, '{%s}polyline' % SVG, {'points': points})
+    _write(outdir, 'shapes.svg', ET.tostring(root, xml_declaration=True))
+
+    # Cursor movements, hidden from time to time
+    root = ET.Element('recording', {'id': 'cursor_events'})
+    for t in sorted(rng.uniform(0, duration) for _ in range(cursor_events)):
+        event = ET.SubElement(root, 'event', {'timestamp': '{:.3f}'.format(t)})
+        cursor = ET.SubElement(event, 'cursor')
+        if rng.random() < 0.05:
+            cursor.text = '-1.0 -1.0'
+        else:
+            cursor.text = '{:.4f} {:.4f}'.format(rng.random(), rng.random())
+    _write(outdir, 'cursor.xml', ET.tostring(root, xml_declaration=True))
+
+    root = ET.Element('recording', {'id': 'deskshare_events'})
+    for i in range(deskshare_events):
+        start = duration * (2 * i + 1) / (2 * deskshare_events + 1)
+        ET.SubElement(root, 'event', {
+            'start_timestamp': '{:.1f}'.format(start),
+            'stop_timestamp': '{:.1f}'.format(start + duration / (4 * deskshare_events + 2)),
+            'video_width': str(width), 'video_height': str(height)})
+    _write(outdir, 'deskshare.xml', ET.tostring(root, xml_declaration=True))
+
+    # dot.png is looked up relative to the working directory by
+    # make-xges.py, but a copy keeps the recording self contained.
+    _write(outdir, 'dot.png', png_data(10, 10, (255, 0, 0)))
+
+    for path, audio in (('video/webcams.webm', True),
+                        ('deskshare/deskshare.webm', False)):
+        if video:
+            path = os.path.join(outdir, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_webm(path, duration, 64, 48, audio)
+        else:
+            _write(outdir, path, rng.randbytes(placeholder_size))
+
+
+class _RecordingHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        prefix = '/presentation/{}/'.format(server.recording_id)
+        path = self.path.split('?', 1)[0]
+        if not path.startswith(prefix):
+            self.send_error(404)
+            return
+        filename = os.path.normpath(os.path.join(server.directory, path[len(prefix):]))
+        if (not filename.startswith(os.path.join(server.directory, '')) or
+                not os.path.isfile(filename)):
+            self.send_error(404)
+            return
+
+        st = os.stat(filename)
+        etag = '"{:x}-{:x}"'.format(st.st_mtime_ns, st.st_size)
+        last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        first, last = 0, st.st_size - 1
+        status = 200
+        range_header = self.headers.get('Range')
+        if (range_header and server.ranges and
+                self.headers.get('If-Range') in (None, etag, last_modified)):
+            spec = range_header.split('=', 1)[1]
+            start, end = spec.split('-', 1)
+            first = int(start)
+            if end:
+                last = min(int(end), st.st_size - 1)
+            if first >= st.st_size:
+                self.send_error(416)
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('Accept-Ranges', 'bytes' if server.ranges else 'none')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                first, last, st.st_size))
+        self.send_header('Content-Length', str(last - first + 1))
+        self.end_headers()
+        with open(filename, 'rb') as fp:
+            fp.seek(first)
+            remaining = last - first + 1
+            while remaining > 0:
+                data = fp.read(min(remaining, 64 * 1024))
+                if not data:
+                    break
+                self.wfile.write(data)
+                remaining -= len(data)
+
+
+class RecordingServer(http.server.ThreadingHTTPServer):
+    """Serve a recording directory like a BBB server, in a thread.
+
+    latency (in seconds) is added to every request to simulate a
+    remote server.  If ranges is False, Range headers are ignored.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, directory, recording_id='synthetic', latency=0,
+                 ranges=True):
+        super().__init__(('127.0.0.1', 0), _RecordingHandler)
+        self.directory = os.path.abspath(directory)
+        self.recording_id = recording_id
+        self.latency = latency
+        self.ranges = ranges
+        self._thread = None
+
+    @property
+    def url(self):
+        """The playback URL to pass to download.py."""
+        return 'http://127.0.0.1:{}/playback/presentation/2.3/{}'.format(
+            self.server_address[1], self.recording_id)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self._thread.join()
+        self.server_close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='generate a synthetic BigBlueButton recording')
+    parser.add_argument('--slides', metavar='N', type=int, default=10,
+                        help='Number of slides')
+    parser.add_argument('--canvases', metavar='N', type=int, default=None,
+                        help='Number of slides with annotations (default: all)')
+    parser.add_argument('--shapes', metavar='N', type=int, default=100,
+                        help='Number of annotation shapes')
+    parser.add_argument('--cursor-events', metavar='N', type=int, default=1000,
+                        help='Number of cursor events')
+    parser.add_argument('--deskshare-events', metavar='N', type=int, default=2,
+                        help='Number of deskshare events')
+    parser.add_argument('--duration', metavar='SECONDS', type=int, default=600,
+                        help='Length of the recording')
+    parser.add_argument('--no-video', dest='video', action='store_false',
+                        help='Write random data instead of webcam and deskshare '
+                        'videos (does not need GStreamer)')
+    parser.add_argument('--placeholder-size', metavar='BYTES', type=int,
+                        default=1024 * 1024,
+                        help='Size of the placeholder videos with --no-video')
+    parser.add_argument('--seed', metavar='N', type=int, default=0,
+                        help='Random seed')
+    parser.add_argument('--serve', action='store_true', default=False,
+                        help='Serve the recording over HTTP until interrupted')
+    parser.add_argument('--latency', metavar='SECONDS', type=float, default=0,
+                        help='Delay added to each HTTP request')
+    parser.add_argument('outdir', metavar='OUTPUT-DIR', type=str,
+                        help='directory to write the recording to')
+    opts = parser.parse_args(argv[1:])
+    generate(opts.outdir, slides=opts.slides, canvases=opts.canvases,
+             shapes=opts.shapes, cursor_events=opts.cursor_events,
+             deskshare_events=opts.deskshare_events, duration=opts.duration,
+             video=opts.video, placeholder_size=opts.placeholder_size,
+             seed=opts.seed)
+    if opts.serve:
+        with RecordingServer(opts.outdir, latency=opts.latency) as server:
+            print('Serving {}'.format(server.url))
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                pass
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))